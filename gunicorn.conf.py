@@ -0,0 +1,34 @@
+import os
+
+wsgi_app = "suprachat_backend:create_app()"
+bind = os.getenv("GUNICORN_BIND") or "127.0.0.1:5000"
+workers = int(os.getenv("GUNICORN_WORKERS") or 4)
+
+# Every open event stream (GET /api/v1/events) holds a whole sync worker; with
+# "gevent" a worker holds thousands of them, one greenlet each. Anything that
+# keeps the CPU busy stalls all of them, so password hashing runs on gevent's
+# thread pool, see utils/passwd.py
+worker_class = os.getenv("GUNICORN_WORKER_CLASS") or "gevent"
+
+# A handful of clients would be enough to take every sync worker, so the
+# event streams are left out unless the workers are asynchronous
+if worker_class not in ("gevent", "eventlet"):
+    os.environ["EVENTS_ENABLED"] = "0"
+
+# Import and configure the app once in the master process, workers get it by
+# forking and only have to open their own connections. gevent and eventlet
+# have to patch the standard library before the app is imported, so it can't
+# be preloaded for them
+preload_app = worker_class not in ("gevent", "eventlet")
+
+
+def post_worker_init(worker):
+    from suprachat_backend import lifecycle
+
+    lifecycle.post_fork()
+
+
+def worker_exit(server, worker):
+    from suprachat_backend import lifecycle
+
+    lifecycle.shutdown()
@@ -5,10 +5,22 @@ from flask import Flask
 from flask_cors import CORS
 from werkzeug.middleware.proxy_fix import ProxyFix
 
-from . import db
+from . import db, lifecycle
+from .blueprints.events import bp as events_bp
 from .blueprints.files import bp as files_bp
+from .blueprints.health import bp as health_bp
 from .blueprints.user import bp as users_bp
-from .utils import buntdb_to_mongodb
+from .utils import (
+    activity,
+    buntdb_to_mongodb,
+    events,
+    invalidation,
+    log,
+    presence,
+    registration,
+    transfer,
+    uploads,
+)
 
 
 load_dotenv()
@@ -23,7 +35,35 @@ def create_app(test_config=None):
         CORS_ORIGINS="*",
         WEBIRCPASS=os.getenv("WEBIRC_PASSWORD"),
         UPLOAD_FOLDER=os.path.join(app.instance_path, "uploads"),
+        UPLOAD_PARTIAL_FOLDER=os.path.join(app.instance_path, "uploads-partial"),
+        UPLOAD_SESSION_TTL=int(os.getenv("UPLOAD_SESSION_TTL") or 86400),
+        UPLOAD_CHUNK_MAX=int(os.getenv("UPLOAD_CHUNK_MAX") or 1048576),
         MAX_CONTENT_LENGTH=int(os.getenv("MAX_CONTENT_LENGTH") or 3000000),
+        CASEMAPPING=os.getenv("CASEMAPPING") or "precis",
+        ERGO_CONFIG=os.getenv("ERGO_CONFIG"),
+        RESERVED_NICKS=os.getenv("RESERVED_NICKS"),
+        REGISTERED_NICKS_TTL=int(os.getenv("REGISTERED_NICKS_TTL") or 300),
+        READ_PREFERENCES=os.getenv("READ_PREFERENCES") or db.DEFAULT_READ_PREFERENCES,
+        READ_MAX_STALENESS=int(os.getenv("READ_MAX_STALENESS") or 90),
+        MAX_BATCH_NICKS=int(os.getenv("MAX_BATCH_NICKS") or 500),
+        ACTIVITY_FLUSH_INTERVAL=float(os.getenv("ACTIVITY_FLUSH_INTERVAL") or 5),
+        ACTIVITY_MAX_PENDING=int(os.getenv("ACTIVITY_MAX_PENDING") or 10000),
+        CHANGES_PAGE_SIZE=int(os.getenv("CHANGES_PAGE_SIZE") or 500),
+        CHANGES_SAFETY_LAG=float(os.getenv("CHANGES_SAFETY_LAG") or 5),
+        PROFILE_CACHE_SIZE=int(os.getenv("PROFILE_CACHE_SIZE") or 10000),
+        PROFILE_CACHE_TTL=int(os.getenv("PROFILE_CACHE_TTL") or 3600),
+        INVALIDATION_POLL_INTERVAL=float(os.getenv("INVALIDATION_POLL_INTERVAL") or 2),
+        EVENTS_ENABLED=os.getenv("EVENTS_ENABLED") != "0",
+        EVENTS_MAX_STREAMS=int(os.getenv("EVENTS_MAX_STREAMS") or 1000),
+        EVENTS_MAX_QUEUED=int(os.getenv("EVENTS_MAX_QUEUED") or 100),
+        EVENTS_HEARTBEAT=float(os.getenv("EVENTS_HEARTBEAT") or 15),
+        IRC_HOST=os.getenv("IRC_HOST") or "127.0.0.1",
+        IRC_PORT=int(os.getenv("IRC_PORT") or 6667),
+        PRESENCE_NICK=os.getenv("PRESENCE_NICK") or "SupraPresence",
+        PRESENCE_RESYNC_INTERVAL=float(os.getenv("PRESENCE_RESYNC_INTERVAL") or 300),
+        LOG_LEVEL=os.getenv("LOG_LEVEL") or "INFO",
+        LOG_SAMPLING=os.getenv("LOG_SAMPLING"),
+        LOG_QUEUE_SIZE=int(os.getenv("LOG_QUEUE_SIZE") or 10000),
     )
 
     if test_config is None:
@@ -31,17 +71,31 @@ def create_app(test_config=None):
     else:
         app.config.from_mapping(test_config)
 
-    try:
-        os.makedirs(app.config["UPLOAD_FOLDER"])
-    except OSError:
-        pass
+    os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
+    os.makedirs(app.config["UPLOAD_PARTIAL_FOLDER"], exist_ok=True)
 
+    # Nothing in here opens a connection, so the app can be created in
+    # gunicorn's master process with --preload and then forked; per-worker
+    # state (including the logging thread) is set up by lifecycle.post_fork,
+    # see gunicorn.conf.py
+    log.init_app(app)
     CORS(app)
-    db.mongo.init_app(app)
+    db.connect(app)
     db.init_app(app)
+    lifecycle.init_app(app)
+    registration.init_app(app)
+    activity.init_app(app)
+    invalidation.init_app(app)
+    presence.init_app(app)
+    events.init_app(app)
     buntdb_to_mongodb.init_app(app)
+    uploads.init_app(app)
+    transfer.init_app(app)
+    app.register_blueprint(health_bp)
     app.register_blueprint(users_bp)
     app.register_blueprint(files_bp)
+    if app.config["EVENTS_ENABLED"]:
+        app.register_blueprint(events_bp)
 
     app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_host=1)
 
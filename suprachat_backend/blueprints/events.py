@@ -0,0 +1,10 @@
+from flask import Blueprint, request
+
+from suprachat_backend.controllers.events import stream
+
+bp = Blueprint("events", __name__)
+
+
+@bp.get("/api/v1/events")
+def events():
+    return stream(request)
@@ -1,6 +1,12 @@
 from flask import Blueprint, request
 
 from suprachat_backend.controllers.files import download, upload
+from suprachat_backend.controllers.uploads import (
+    append_chunk,
+    create_session,
+    finalize,
+    get_offset,
+)
 from suprachat_backend.utils.auth import token_required
 
 bp = Blueprint("files", __name__)
@@ -15,3 +21,27 @@ def download_file(name):
 @token_required
 def upload_file(current_user):
     return upload(current_user, request)
+
+
+@bp.post("/api/v1/uploads")
+@token_required
+def upload_session(current_user):
+    return create_session(current_user, request)
+
+
+@bp.route("/api/v1/uploads/<string:session_id>", methods=["HEAD"])
+@token_required
+def upload_offset(current_user, session_id):
+    return get_offset(current_user, session_id)
+
+
+@bp.patch("/api/v1/uploads/<string:session_id>")
+@token_required
+def upload_chunk(current_user, session_id):
+    return append_chunk(current_user, session_id, request)
+
+
+@bp.post("/api/v1/uploads/<string:session_id>/finalize")
+@token_required
+def upload_finalize(current_user, session_id):
+    return finalize(current_user, session_id)
@@ -0,0 +1,15 @@
+from flask import Blueprint
+
+from suprachat_backend.controllers.health import healthz, readyz
+
+bp = Blueprint("health", __name__)
+
+
+@bp.get("/healthz")
+def health():
+    return healthz()
+
+
+@bp.get("/readyz")
+def ready():
+    return readyz()
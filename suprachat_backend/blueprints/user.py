@@ -1,16 +1,20 @@
 from flask import Blueprint, request
-from webargs.flaskparser import use_args
 
 from suprachat_backend.controllers.user import (
     create,
     get_all,
+    get_changes,
+    get_many,
     get_one,
+    get_online,
+    get_presence,
     login,
     update,
     verify,
 )
 from suprachat_backend.models.user import make_user_schema
 from suprachat_backend.utils.auth import token_required
+from suprachat_backend.utils.body import use_args
 
 
 bp = Blueprint("users", __name__)
@@ -21,11 +25,31 @@ def users():
     return get_all()
 
 
+@bp.get("/api/v1/users/changes")
+def users_changes():
+    return get_changes(request)
+
+
+@bp.get("/api/v1/users/online")
+def users_online():
+    return get_online()
+
+
 @bp.get("/api/v1/users/<string:nick>")
 def user(nick):
     return get_one(nick)
 
 
+@bp.post("/api/v1/users/batch")
+def users_batch():
+    return get_many(request)
+
+
+@bp.post("/api/v1/users/presence")
+def users_presence():
+    return get_presence(request)
+
+
 @bp.post("/api/v1/users/signup")
 @use_args(make_user_schema)
 def signup(args):
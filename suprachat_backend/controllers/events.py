@@ -0,0 +1,138 @@
+import json
+import logging
+import queue
+
+from flask import current_app, make_response, Response, stream_with_context
+from pymongo import ASCENDING
+
+from suprachat_backend.controllers.user import (
+    NOT_PENDING,
+    PUBLIC_USER_PROJECTION,
+    serialize_user,
+)
+from suprachat_backend.db import mongo
+from suprachat_backend.utils.casemapping import nick_key
+from suprachat_backend.utils.events import RESET
+from suprachat_backend.utils.watermark import (
+    changed_since,
+    decode_watermark,
+    encode_watermark,
+)
+
+logger = logging.getLogger(__name__)
+
+# How long clients wait before reconnecting, in milliseconds
+RETRY = 5000
+
+
+def _format(event, data, event_id=None):
+    lines = [f"event: {event}", f"data: {json.dumps(data, ensure_ascii=False)}"]
+    if event_id is not None:
+        lines.insert(0, f"id: {event_id}")
+    return "\n".join(lines) + "\n\n"
+
+
+def _mark(user):
+    return (user["updated_at"], user["_id"]) if "updated_at" in user else None
+
+
+def _format_change(user):
+    mark = _mark(user)
+    event_id = encode_watermark(*mark) if mark is not None else None
+    if user.get("active", True) is False:
+        return _format(
+            "deleted", {"_id": str(user["_id"]), "nick": user["nick"]}, event_id
+        )
+    return _format("profile", serialize_user(user), event_id)
+
+
+def _replay(keys, since):
+    """Returns the changes after 'since' for the nicks in 'keys', or None if
+    there are too many to replay."""
+    query = {**changed_since(*since), **NOT_PENDING}
+    if keys is not None:
+        query["nick_cf"] = {"$in": list(keys)}
+    limit = current_app.config["CHANGES_PAGE_SIZE"]
+    changes = list(
+        mongo.db.users.find(
+            query,
+            {
+                **PUBLIC_USER_PROJECTION,
+                "nick_cf": True,
+                "active": True,
+                "updated_at": True,
+            },
+        )
+        .sort([("updated_at", ASCENDING), ("_id", ASCENDING)])
+        .limit(limit + 1)
+    )
+    return changes if len(changes) <= limit else None
+
+
+def stream(request):
+    keys = None
+    if request.args.get("nicks"):
+        keys = {nick_key(nick) for nick in request.args["nicks"].split(",") if nick}
+        max_nicks = current_app.config["MAX_BATCH_NICKS"]
+        if len(keys) > max_nicks:
+            message = f"No se pueden seguir más de {max_nicks} nicks a la vez."
+            return make_response(({"error": message}, 413))
+
+    since = None
+    last_event_id = request.headers.get("Last-Event-ID")
+    if last_event_id:
+        try:
+            since = decode_watermark(last_event_id)
+        except ValueError:
+            return make_response(({"error": "Last-Event-ID inválido."}, 400))
+
+    hub = current_app.extensions["events"]
+    # Subscribe before replaying so nothing committed in between is lost, the
+    # duplicates are skipped below
+    subscription = hub.subscribe(keys)
+    if subscription is None:
+        return make_response(
+            ({"error": "Demasiadas conexiones, intenta más tarde."}, 503)
+        )
+    heartbeat = current_app.config["EVENTS_HEARTBEAT"]
+
+    def generate():
+        yield f"retry: {RETRY}\n\n"
+        # Live events can arrive out of order, only the ones already sent by
+        # the replay are skipped
+        replayed = since
+        if since is not None:
+            changes = _replay(keys, since)
+            if changes is None:
+                # Too far behind, the client should resync with
+                # GET /api/v1/users/changes and carry on with the live events
+                yield _format("reset", {})
+                changes = []
+            for user in changes:
+                replayed = _mark(user)
+                yield _format_change(user)
+
+        while not subscription.overflowed:
+            try:
+                event = subscription.queue.get(timeout=heartbeat)
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+            if event is RESET:
+                yield _format("reset", {})
+                continue
+            mark = _mark(event)
+            if replayed is not None and mark is not None and mark <= replayed:
+                continue
+            yield _format_change(event)
+        # Closing makes the client reconnect and replay from its last id
+        logger.info("Stream de eventos desbordado, se cierra")
+
+    response = Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    # Runs even if the stream is closed before it starts
+    response.call_on_close(lambda: hub.unsubscribe(subscription))
+    return response
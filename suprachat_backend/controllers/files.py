@@ -1,33 +1,144 @@
+import datetime as dt
+import logging
 import os
 from uuid import uuid4
 
 from flask import current_app, make_response, send_from_directory
+from werkzeug.exceptions import ClientDisconnected, RequestEntityTooLarge
+from werkzeug.sansio.multipart import (
+    Data,
+    Epilogue,
+    Field,
+    File,
+    MultipartDecoder,
+    NeedData,
+)
 
 from suprachat_backend.db import mongo
-from suprachat_backend.utils.files import allowed_filename
+from suprachat_backend.utils.cache import evict_profile
+from suprachat_backend.utils.files import (
+    allowed_filename,
+    SNIFF_SIZE,
+    sniff_image_type,
+)
+
+logger = logging.getLogger(__name__)
+
+# How much of the request body is read at a time
+READ_SIZE = 64 * 1024
 
 
 def download(name):
     file = name if name != "null" else "default.png"
-    current_app.logger.info(f"Descargando archivo: {file}")
+    logger.info("Descargando archivo: %s", file)
     return send_from_directory(current_app.config["UPLOAD_FOLDER"], file)
 
 
+def set_picture(current_user, original_filename, filename):
+    mongo.db.users.update_one(
+        {"_id": current_user["_id"]},
+        {"$set": {"picture": filename, "updated_at": dt.datetime.utcnow()}},
+    )
+    evict_profile(current_user["_id"])
+    logger.info("Se guardó la imagen %s como %s", original_filename, filename)
+
+
+def _error(message, status):
+    return make_response(({"success": False, "message": message}, status))
+
+
+def _events(request, decoder, max_size):
+    """Feeds the request body to 'decoder' as it arrives and yields the
+    multipart events it produces. Raises RequestEntityTooLarge once more than
+    'max_size' bytes have been read, which also covers chunked bodies that
+    don't declare a Content-Length."""
+    received = 0
+    while True:
+        event = decoder.next_event()
+        if isinstance(event, NeedData):
+            data = request.stream.read(READ_SIZE)
+            received += len(data)
+            if received > max_size:
+                raise RequestEntityTooLarge()
+            decoder.receive_data(data or None)
+        elif isinstance(event, Epilogue):
+            return
+        else:
+            yield event
+
+
 def upload(current_user, request):
-    if "file" not in request.files:
-        return make_response(
-            ({"success": False, "message": "File not present in request."}, 400)
-        )
-    file = request.files["file"]
-    if not file.filename:
-        return make_response(
-            ({"success": False, "message": "File not present in request."}, 400)
-        )
-    if file and allowed_filename(file.filename):
-        filename = f"{uuid4().hex}.{file.filename.split('.')[-1]}"
-        file.save(os.path.join(current_app.config["UPLOAD_FOLDER"], filename))
-        mongo.db.users.update_one(
-            {"nick": current_user["nick"]}, {"$set": {"picture": filename}}
-        )
-        current_app.logger.info(f"Se guardó la imagen {file.filename} como {filename}")
-        return make_response(({"message": "Upload successful.", "path": filename}, 200))
+    boundary = request.mimetype_params.get("boundary")
+    if request.mimetype != "multipart/form-data" or not boundary:
+        return _error("File not present in request.", 400)
+
+    # Everything is checked as the body streams in, so a bad upload is rejected
+    # after reading a few KB, and nothing is written to disk until the content
+    # is known to be an image
+    max_size = current_app.config["MAX_CONTENT_LENGTH"]
+    if request.content_length is not None and request.content_length > max_size:
+        return _error("File too large.", 413)
+
+    decoder = MultipartDecoder(
+        boundary.encode("latin-1"), max_form_memory_size=max_size
+    )
+    original_filename = None
+    reading_file = False
+    complete = False
+    head = b""
+    out = None
+    path = None
+
+    try:
+        for event in _events(request, decoder, max_size):
+            if isinstance(event, File) and event.name == "file" and not complete:
+                if not event.filename:
+                    return _error("File not present in request.", 400)
+                if not allowed_filename(event.filename):
+                    return _error("File type not allowed.", 415)
+                original_filename = event.filename
+                reading_file = True
+            elif isinstance(event, (Field, File)):
+                reading_file = False
+            elif isinstance(event, Data) and reading_file:
+                if out is None:
+                    head += event.data
+                    if len(head) < SNIFF_SIZE and event.more_data:
+                        continue
+                    extension = sniff_image_type(head)
+                    if extension is None:
+                        return _error("File type not allowed.", 415)
+                    path = os.path.join(
+                        current_app.config["UPLOAD_FOLDER"],
+                        f"{uuid4().hex}.{extension}",
+                    )
+                    out = open(path, "xb")
+                    out.write(head)
+                else:
+                    out.write(event.data)
+
+                if not event.more_data:
+                    reading_file = False
+                    complete = True
+    except ValueError:
+        # Malformed multipart body, or a form field over the memory limit
+        return _error("Malformed request.", 400)
+    except RequestEntityTooLarge:
+        return _error("File too large.", 413)
+    except ClientDisconnected:
+        return _error("Upload interrupted.", 400)
+    finally:
+        if out is not None:
+            out.close()
+            if not complete:
+                # Rejected or cut short, drop what was written
+                os.remove(path)
+
+    if not complete:
+        if original_filename is None:
+            return _error("File not present in request.", 400)
+        return _error("File type not allowed.", 415)
+
+    filename = os.path.basename(path)
+    set_picture(current_user, original_filename, filename)
+    return make_response(({"message": "Upload successful.", "path": filename}, 200))
@@ -0,0 +1,42 @@
+import os
+
+from flask import current_app, make_response
+
+
+def healthz():
+    return make_response(
+        (
+            {
+                "status": "ok",
+                "pid": os.getpid(),
+                "activity": current_app.extensions["activity"].stats(),
+                "log_dropped": current_app.extensions["log_pipeline"].handler.dropped,
+                "profile_cache": current_app.extensions["profile_cache"].stats(),
+                "invalidation": current_app.extensions["invalidation_bus"].stats(),
+                "presence": current_app.extensions["presence"].stats(),
+                "events": current_app.extensions["events"].stats(),
+            },
+            200,
+        )
+    )
+
+
+def readyz():
+    state = current_app.extensions["lifecycle"]
+    if not state.ready:
+        return make_response(
+            # The details are in the log, they may reveal how MongoDB is set up
+            ({"ready": False, "pid": os.getpid(), "error": "warmup failed"}, 503)
+        )
+    return make_response(
+        (
+            {
+                "ready": True,
+                "pid": state.pid,
+                "warmed_at": state.warmed_at,
+                # Missing indexes don't keep the worker from serving requests
+                "indexes": "failed" if state.index_errors else "ok",
+            },
+            200,
+        )
+    )
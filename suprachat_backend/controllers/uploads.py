@@ -0,0 +1,220 @@
+import base64
+import binascii
+import datetime as dt
+import fcntl
+import logging
+import os
+from uuid import uuid4
+
+from flask import current_app, make_response
+from pymongo import ReturnDocument
+from werkzeug.exceptions import ClientDisconnected
+
+from suprachat_backend.controllers.files import READ_SIZE, set_picture
+from suprachat_backend.db import mongo
+from suprachat_backend.utils.files import (
+    allowed_filename,
+    SNIFF_SIZE,
+    sniff_image_type,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _error(message, status):
+    return make_response(({"success": False, "message": message}, status))
+
+
+def _part_path(session_id):
+    return os.path.join(
+        current_app.config["UPLOAD_PARTIAL_FOLDER"], f"{session_id}.part"
+    )
+
+
+def _expires_at():
+    return dt.datetime.utcnow() + dt.timedelta(
+        seconds=current_app.config["UPLOAD_SESSION_TTL"]
+    )
+
+
+def _find_session(current_user, session_id):
+    return mongo.db.upload_sessions.find_one(
+        {"_id": session_id, "user_id": current_user["_id"]}
+    )
+
+
+def _offset_response(session, status, body=""):
+    response = make_response((body, status))
+    response.headers["Upload-Offset"] = str(session["offset"])
+    response.headers["Upload-Length"] = str(session["length"])
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+
+def _parse_metadata(header):
+    """Parses a tus `Upload-Metadata` header: comma-separated pairs of a key and
+    a base64-encoded value."""
+    metadata = {}
+    for pair in header.split(","):
+        key, _, value = pair.strip().partition(" ")
+        if key:
+            metadata[key] = base64.b64decode(value, validate=True).decode("utf-8")
+    return metadata
+
+
+def create_session(current_user, request):
+    try:
+        length = int(request.headers["Upload-Length"])
+        filename = _parse_metadata(request.headers.get("Upload-Metadata", ""))[
+            "filename"
+        ]
+    except (KeyError, ValueError, binascii.Error):
+        return _error(
+            "Upload-Length and a filename in Upload-Metadata are required.", 400
+        )
+
+    if not 0 < length <= current_app.config["MAX_CONTENT_LENGTH"]:
+        return _error("File too large.", 413)
+    if not allowed_filename(filename):
+        return _error("File type not allowed.", 415)
+
+    session = {
+        "_id": uuid4().hex,
+        "user_id": current_user["_id"],
+        "filename": filename,
+        "length": length,
+        "offset": 0,
+        "created_at": dt.datetime.utcnow(),
+        "expires_at": _expires_at(),
+    }
+    # Create the file first, a session without one would be useless
+    open(_part_path(session["_id"]), "xb").close()
+    mongo.db.upload_sessions.insert_one(session)
+    logger.info("Subida %s iniciada: %s, %s bytes", session["_id"], filename, length)
+
+    response = _offset_response(
+        session,
+        201,
+        {
+            "id": session["_id"],
+            "offset": 0,
+            "length": length,
+            "expires_at": session["expires_at"].isoformat(),
+        },
+    )
+    response.headers["Location"] = f"/api/v1/uploads/{session['_id']}"
+    return response
+
+
+def get_offset(current_user, session_id):
+    session = _find_session(current_user, session_id)
+    if session is None:
+        return _error("Upload not found.", 404)
+    return _offset_response(session, 200)
+
+
+def append_chunk(current_user, session_id, request):
+    session = _find_session(current_user, session_id)
+    if session is None:
+        return _error("Upload not found.", 404)
+
+    if request.mimetype != "application/offset+octet-stream":
+        return _error("Chunks must be sent as application/offset+octet-stream.", 415)
+    try:
+        offset = int(request.headers["Upload-Offset"])
+    except (KeyError, ValueError):
+        return _error("Upload-Offset is required.", 400)
+    if offset != session["offset"]:
+        return _offset_response(session, 409)
+
+    remaining = session["length"] - offset
+    if request.content_length is not None and (
+        request.content_length > remaining
+        or request.content_length > current_app.config["UPLOAD_CHUNK_MAX"]
+    ):
+        return _error("Chunk too large.", 413)
+    limit = min(remaining, current_app.config["UPLOAD_CHUNK_MAX"])
+
+    try:
+        part = open(_part_path(session_id), "r+b")
+    except FileNotFoundError:
+        mongo.db.upload_sessions.delete_one({"_id": session_id})
+        return _error("Upload not found.", 404)
+
+    written = 0
+    with part:
+        try:
+            fcntl.flock(part, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return _error("Another chunk of this upload is being written.", 409)
+
+        # Bytes past the recorded offset belong to a chunk whose offset was
+        # never saved, they'll be sent again
+        part.truncate(offset)
+        part.seek(offset)
+        try:
+            while written < limit:
+                data = request.stream.read(min(READ_SIZE, limit - written))
+                if not data:
+                    break
+                # Reject anything that isn't an image as soon as it starts
+                if (
+                    offset == 0
+                    and written == 0
+                    and len(data) >= min(SNIFF_SIZE, session["length"])
+                    and sniff_image_type(data) is None
+                ):
+                    mongo.db.upload_sessions.delete_one({"_id": session_id})
+                    os.remove(_part_path(session_id))
+                    return _error("File type not allowed.", 415)
+                part.write(data)
+                written += len(data)
+            # Anything left in the body would go past the announced length
+            if written == limit and request.stream.read(1):
+                part.truncate(offset)
+                return _error("Chunk too large.", 413)
+        except ClientDisconnected:
+            # Keep what arrived, the client resumes from there
+            pass
+        part.flush()
+        os.fsync(part.fileno())
+
+        session = mongo.db.upload_sessions.find_one_and_update(
+            {"_id": session_id, "offset": offset},
+            {"$set": {"offset": offset + written, "expires_at": _expires_at()}},
+            return_document=ReturnDocument.AFTER,
+        )
+    if session is None:
+        return _error("Upload not found.", 404)
+
+    return _offset_response(session, 204)
+
+
+def finalize(current_user, session_id):
+    session = _find_session(current_user, session_id)
+    if session is None:
+        return _error("Upload not found.", 404)
+    if session["offset"] != session["length"]:
+        return _offset_response(session, 409)
+
+    with open(_part_path(session_id), "rb") as part:
+        extension = sniff_image_type(part.read(SNIFF_SIZE))
+    if extension is None:
+        mongo.db.upload_sessions.delete_one({"_id": session_id})
+        os.remove(_part_path(session_id))
+        return _error("File type not allowed.", 415)
+
+    filename = f"{uuid4().hex}.{extension}"
+    # Claim the session so a concurrent finalize can't move the file twice
+    if not mongo.db.upload_sessions.delete_one({"_id": session_id}).deleted_count:
+        return _error("Upload not found.", 404)
+    try:
+        os.replace(
+            _part_path(session_id),
+            os.path.join(current_app.config["UPLOAD_FOLDER"], filename),
+        )
+    except FileNotFoundError:
+        return _error("Upload not found.", 404)
+
+    set_picture(current_user, session["filename"], filename)
+    return make_response(({"message": "Upload successful.", "path": filename}, 200))
@@ -1,113 +1,392 @@
 import datetime as dt
-import json
+import logging
 
 from flask import current_app, jsonify, make_response
 import jwt
-from werkzeug.security import check_password_hash, generate_password_hash
-
-from suprachat_backend.db import mongo
+from pymongo import ASCENDING, ReadPreference
+from pymongo.errors import DuplicateKeyError
+
+from suprachat_backend.db import mongo, read_collection
+from suprachat_backend.utils.activity import ACTIVITY_FIELDS, record_activity
+from suprachat_backend.utils.body import json_body
+from suprachat_backend.utils.cache import evict_profile
+from suprachat_backend.utils.casemapping import nick_key
 from suprachat_backend.utils.irc import IRCClient
 from suprachat_backend.utils.passwd import (
     check_password_hash as check_password_hash_ergo,
+    hash_password,
+    verify_password,
+)
+from suprachat_backend.utils.registration import validate_registration
+from suprachat_backend.utils.timing import StageTimer
+from suprachat_backend.utils.watermark import (
+    changed_since,
+    decode_watermark,
+    encode_watermark,
 )
-from suprachat_backend.utils.validate_string import validate_string
 
+logger = logging.getLogger(__name__)
 
-def get_all():
-    users = mongo.db.users.find({})
-    user_list = []
-    for user in users:
-        user_list.append(
-            {
-                "_id": str(user["_id"]),
-                "nick": user["nick"],
-                "email": user["email"],
-                "registered_date": user["registered_date"],
-                "password_from": user.get("password_from", None),
-                "country": user.get("country", None),
-                "about": user.get("about", None),
-                "picture": user.get("picture", None),
-            }
-        )
-    return jsonify(user_list)
 
+PUBLIC_USER_PROJECTION = {
+    "nick": True,
+    "email": True,
+    "registered_date": True,
+    "password_from": True,
+    "country": True,
+    "about": True,
+    "picture": True,
+    "last_login": True,
+    "last_seen": True,
+}
 
-def get_one(nick):
-    user = mongo.db.users.find_one({"nick": nick})
-    if not user:
-        return make_response(({"error": "Usuario no encontrado."}, 404))
+
+# Signups hold a reservation document until the IRCd accepts them, reads must
+# skip those
+NOT_PENDING = {"pending": {"$ne": True}}
+
+# HTTP status and message for each error code of `validate_registration`
+REGISTRATION_ERROR_RESPONSES = {
+    "INVALID_USERNAME": (
+        422,
+        "Nick contiene caracteres prohibidos, es muy corto o muy largo.",
+    ),
+    "DISALLOWED": (422, "Ese nick está reservado."),
+    "USERNAME_EXISTS": (409, "Nick o correo ya se encuentra en uso."),
+    "INVALID_PASSWORD": (
+        422,
+        "Contraseña contiene espacios o caracteres prohibidos.",
+    ),
+}
+
+
+def _isoformat(date):
+    return date.isoformat() if date is not None else None
+
+
+def serialize_user(user):
     return {
         "_id": str(user["_id"]),
         "nick": user["nick"],
-        "email": user["email"],
+        "email": user.get("email", None),
         "registered_date": user.get("registered_date", None),
         "password_from": user.get("password_from", None),
         "country": user.get("country", None),
         "about": user.get("about", None),
         "picture": user.get("picture", None),
+        "last_login": _isoformat(user.get("last_login", None)),
+        "last_seen": _isoformat(user.get("last_seen", None)),
     }
 
 
+def get_all():
+    users = read_collection("users").find(NOT_PENDING, PUBLIC_USER_PROJECTION)
+    return jsonify([serialize_user(user) for user in users])
+
+
+def _get_profiles(keys) -> dict:
+    """Returns the public profiles of the users with the casefolded nicks in
+    'keys', from the cache when possible, keyed by casefolded nick.
+
+    The activity timestamps change too often to be cached (the invalidation
+    bus ignores them), so they are always read from the database.
+    """
+    cache = current_app.extensions["profile_cache"]
+    # Without the bus nothing evicts changed profiles, so the cache can't be
+    # trusted
+    use_cache = current_app.extensions["invalidation_bus"].running
+    token = cache.begin()
+    profiles = {}
+    missing = []
+    for key in keys:
+        profile = cache.get(key) if use_cache else None
+        if profile is None:
+            missing.append(key)
+        else:
+            profiles[key] = {**profile, **dict.fromkeys(ACTIVITY_FIELDS)}
+
+    users = read_collection("users")
+    if profiles:
+        for user in users.find(
+            {"nick_cf": {"$in": list(profiles)}, **NOT_PENDING},
+            {"nick_cf": True, **dict.fromkeys(ACTIVITY_FIELDS, True)},
+        ):
+            profiles[user["nick_cf"]].update(
+                {field: _isoformat(user.get(field)) for field in ACTIVITY_FIELDS}
+            )
+    if not missing:
+        return profiles
+
+    # A secondary may still be behind a change the cache was told about, so
+    # what it returns is only kept for as long as it may be stale
+    ttl = (
+        None
+        if users.read_preference.mode == ReadPreference.PRIMARY.mode
+        else current_app.config["READ_MAX_STALENESS"]
+    )
+    for user in users.find(
+        {"nick_cf": {"$in": missing}, **NOT_PENDING},
+        {**PUBLIC_USER_PROJECTION, "nick_cf": True},
+    ):
+        profile = serialize_user(user)
+        if use_cache:
+            cached = {
+                field: value
+                for field, value in profile.items()
+                if field not in ACTIVITY_FIELDS
+            }
+            cache.set(user["nick_cf"], user["_id"], cached, token, ttl)
+        profiles[user["nick_cf"]] = profile
+    return profiles
+
+
+def get_one(nick):
+    key = nick_key(nick)
+    user = _get_profiles([key]).get(key)
+    if not user:
+        return make_response(({"error": "Usuario no encontrado."}, 404))
+    return user
+
+
+def _requested_nicks():
+    """Reads the list of nicks of a batch request. Returns the nicks and None,
+    or None and the error response."""
+    try:
+        nicks = json_body()["nicks"]
+    except (ValueError, KeyError, TypeError):
+        nicks = None
+
+    if not isinstance(nicks, list) or not all(isinstance(n, str) for n in nicks):
+        return None, make_response(
+            ({"error": "Se requiere una lista de nicks."}, 400)
+        )
+
+    # Keep the order the client asked for but drop repeated nicks
+    nicks = list(dict.fromkeys(nicks))
+    max_nicks = current_app.config["MAX_BATCH_NICKS"]
+    if len(nicks) > max_nicks:
+        return None, make_response(
+            ({"error": f"No se pueden pedir más de {max_nicks} nicks a la vez."}, 413)
+        )
+    return nicks, None
+
+
+def get_many(request):
+    nicks, error = _requested_nicks()
+    if error is not None:
+        return error
+
+    keys = {nick: nick_key(nick) for nick in nicks}
+    found = _get_profiles(set(keys.values()))
+
+    return make_response(
+        (
+            {
+                "users": {
+                    nick: found[key] for nick, key in keys.items() if key in found
+                },
+                "not_found": [nick for nick, key in keys.items() if key not in found],
+            },
+            200,
+        )
+    )
+
+
+def get_changes(request):
+    # Writes from different workers don't land in `updated_at` order, so only
+    # the changes older than this are handed out
+    lag = dt.timedelta(seconds=current_app.config["CHANGES_SAFETY_LAG"])
+    page_size = current_app.config["CHANGES_PAGE_SIZE"]
+
+    query = {"updated_at": {"$lte": dt.datetime.utcnow() - lag}, **NOT_PENDING}
+    since = request.args.get("since")
+    if since:
+        try:
+            query.update(changed_since(*decode_watermark(since)))
+        except ValueError:
+            return make_response(({"error": "Marca de sincronización inválida."}, 400))
+
+    changed = list(
+        read_collection("users").find(
+            query, {**PUBLIC_USER_PROJECTION, "active": True, "updated_at": True}
+        )
+        .sort([("updated_at", ASCENDING), ("_id", ASCENDING)])
+        .limit(page_size)
+    )
+
+    if changed:
+        since = encode_watermark(changed[-1]["updated_at"], changed[-1]["_id"])
+    return make_response(
+        (
+            {
+                "users": [
+                    serialize_user(user)
+                    for user in changed
+                    if user.get("active", True) is not False
+                ],
+                # Deactivated users, clients should drop them
+                "deleted": [
+                    {"_id": str(user["_id"]), "nick": user["nick"]}
+                    for user in changed
+                    if user.get("active", True) is False
+                ],
+                "since": since,
+                "has_more": len(changed) == page_size,
+            },
+            200,
+        )
+    )
+
+
+def _presence_unavailable():
+    return make_response(
+        ({"error": "El estado de conexión no está disponible por ahora."}, 503)
+    )
+
+
+def get_online():
+    observer = current_app.extensions["presence"]
+    if not observer.connected:
+        return _presence_unavailable()
+    nicks = observer.online_nicks()
+    # Only the watched users are known, if the IRCd doesn't let us watch all
+    # of them the list is incomplete
+    return make_response(
+        (
+            {
+                "users": nicks,
+                "count": len(nicks),
+                "watched": len(observer.watched),
+                "complete": observer.complete,
+            },
+            200,
+        )
+    )
+
+
+def get_presence(request):
+    nicks, error = _requested_nicks()
+    if error is not None:
+        return error
+
+    observer = current_app.extensions["presence"]
+    if not observer.connected:
+        return _presence_unavailable()
+    # None for the nicks that aren't being watched, e.g. unregistered ones
+    return make_response(
+        ({"online": {nick: observer.is_online(nick) for nick in nicks}}, 200)
+    )
+
+
+def _signup_response(body, status, timer):
+    response = make_response((body, status))
+    response.headers["Server-Timing"] = timer.server_timing()
+    logger.info("Tiempos del registro: %s", timer.server_timing())
+    return response
+
+
 def create(args, request):
     nick = args.get("nick")
     email = args.get("email")
     password = args.get("password")
-    password_hash = generate_password_hash(password)
     registered_date = dt.datetime.now().isoformat()
     verified = False
-
-    # Checks if the user already exists in the MongoDB database or if the
-    # email address is already in use; if it does, don't even bother checking
-    # anything else
-    existing_user = mongo.db.users.find_one({"$or": [{"nick": nick}, {"email": email}]})
-    if existing_user:
-        current_app.logger.info(f"Ya existe un usuario con ese nick o correo: {nick}, {email}")
-        return make_response(({"error": "Nick o correo ya se encuentra en uso."}, 409))
-
-    # Check if nick contains forbidden characters:  ,*?.!@:<>'\";#~&@%+-
-    if not validate_string(nick):
-        current_app.logger.info("Contraseña contiene caracteres prohibidos")
-        return make_response(
-            (
+    timer = StageTimer()
+
+    # The stages go from cheapest to most expensive, so a rejected signup costs
+    # as little as possible: the password is only hashed once the IRCd has
+    # accepted the registration
+
+    # Reject the nicks and passwords Ergo would refuse, and the nicks we know are
+    # already registered, without connecting to the IRCd
+    with timer.stage("validate"):
+        error = validate_registration(nick, password)
+    if error is not None:
+        logger.info("Registro rechazado localmente: %s, %s", nick, error)
+        status, message = REGISTRATION_ERROR_RESPONSES[error]
+        return _signup_response({"error": message, "code": error}, status, timer)
+
+    # Reserve the nick and email; the unique indexes make this atomic, so two
+    # concurrent signups for the same nick can't both get to the IRCd
+    with timer.stage("reserve"):
+        try:
+            res = mongo.db.users.insert_one(
                 {
-                    "error": "Nick contiene caracteres prohibidos, es muy corto"
-                    " o muy largo.",
-                },
-                422,
+                    "nick": nick,
+                    "nick_cf": nick_key(nick),
+                    "email": email,
+                    "registered_date": registered_date,
+                    "pending": True,
+                    "reserved_at": dt.datetime.utcnow(),
+                    "updated_at": dt.datetime.utcnow(),
+                    "active": False,
+                }
             )
+        except DuplicateKeyError:
+            res = None
+    if res is None:
+        logger.info("Ya existe un usuario con ese nick o correo: %s, %s", nick, email)
+        status, message = REGISTRATION_ERROR_RESPONSES["USERNAME_EXISTS"]
+        return _signup_response(
+            {"error": message, "code": "USERNAME_EXISTS"}, status, timer
         )
 
     # Connect to the IRCd and attempt registration
-    client = IRCClient(
-        current_app.config["WEBIRCPASS"],
-        request.remote_addr,
-    )
+    with timer.stage("irc"):
+        client = IRCClient(
+            current_app.config["WEBIRCPASS"],
+            request.remote_addr,
+        )
+        try:
+            if client.connect():
+                ircd_register_response = client.register(nick, email, password)
+            else:
+                ircd_register_response = None
+        except OSError as e:
+            # Reset or timed out halfway through, handled like a failed connect
+            logger.warning("Se perdió la conexión al servidor IRC: %s", e)
+            ircd_register_response = None
+        except BaseException:
+            # Don't leave the nick reserved until the TTL index gets to it
+            mongo.db.users.delete_one({"_id": res.inserted_id, "pending": True})
+            raise
+        finally:
+            client.s.close()
+
+    if ircd_register_response is None or not ircd_register_response["success"]:
+        mongo.db.users.delete_one({"_id": res.inserted_id, "pending": True})
+        if ircd_register_response is None:
+            logger.info("Error al conectarse al servidor IRC")
+            return _signup_response(
+                {"error": "Error de conexión al servidor IRC."}, 500, timer
+            )
+        logger.info("Falló el registro: %s", ircd_register_response["message"])
+        return _signup_response(
+            {"error": ircd_register_response["message"]}, 422, timer
+        )
 
-    if client.connect():
-        ircd_register_response = client.register(nick, email, password)
-    else:
-        current_app.logger.info("Error al conectarse al servidor IRC")
-        return make_response(({"error": "Error de conexión al servidor IRC."}))
-
-    if not ircd_register_response["success"]:
-        current_app.logger.info(f"Falló el registro: {ircd_register_response['message']}")
-        return make_response(({"error": ircd_register_response["message"]}, 422))
-
-    # If registration succeeeds, insert the newly created user into the database
-    res = mongo.db.users.insert_one(
-        {
-            "nick": nick,
-            "password": password_hash,
-            "email": email,
-            "registered_date": registered_date,
-            "password_from": "supra",
-            "verified": verified,
-            "active": True,
-            "country": None,
-            "about": None,
-            "picture": None,
-        }
-    )
+    with timer.stage("hash"):
+        password_hash = hash_password(password)
+
+    # If registration succeeeds, turn the reservation into the actual user
+    with timer.stage("finalize"):
+        mongo.db.users.update_one(
+            {"_id": res.inserted_id},
+            {
+                "$set": {
+                    "password": password_hash,
+                    "password_from": "supra",
+                    "verified": verified,
+                    "active": True,
+                    "country": None,
+                    "about": None,
+                    "picture": None,
+                    "updated_at": dt.datetime.utcnow(),
+                },
+                "$unset": {"pending": "", "reserved_at": ""},
+            },
+        )
+    current_app.extensions["registered_nicks"].add(nick_key(nick))
 
     response = {
         "_id": str(res.inserted_id),
@@ -116,16 +395,16 @@ def create(args, request):
         "registered_date": registered_date,
         "verified": verified,
     }
-    current_app.logger.info("Usuario registrado exitosamente!")
-    return make_response((response, 200))
+    logger.info("Usuario registrado exitosamente!")
+    return _signup_response(response, 200, timer)
 
 
 def verify(request):
-    body = json.loads(request.data)
     try:
+        body = json_body()
         nick = body["nick"]
         code = body["code"]
-    except KeyError:
+    except (ValueError, KeyError, TypeError):
         return make_response(({"error": "Se requiere un código de verificación."}, 400))
     # Connect to the IRCd and attempt registration
     client = IRCClient(
@@ -135,28 +414,38 @@ def verify(request):
     if client.connect():
         ircd_verify_response = client.verify(nick, code)
     else:
-        current_app.logger.info("Error al conectarse al servidor IRC")
+        logger.info("Error al conectarse al servidor IRC")
         return make_response(({"error": "Error de conexión al servidor IRC."}, 500))
 
     if not ircd_verify_response["success"]:
-        current_app.logger.info("Error al verificar el registro")
+        logger.info("Error al verificar el registro")
         return make_response(({"error": ircd_verify_response["message"]}, 400))
 
-    mongo.db.users.update_one({"nick": nick}, {"$set": {"verified": True}})
+    user = mongo.db.users.find_one_and_update(
+        {"nick_cf": nick_key(nick)},
+        {"$set": {"verified": True, "updated_at": dt.datetime.utcnow()}},
+        {"_id": True},
+    )
+    if user is not None:
+        evict_profile(user["_id"])
 
-    current_app.logger.info("Verificación exitosa!")
+    logger.info("Verificación exitosa!")
     return make_response(({"verified": True}, 200))
 
 
 def login(request):
     auth = request.authorization
-    current_app.logger.info(auth)
-    remember_me = json.loads(request.data).get("rememberMe", False)
+    try:
+        remember_me = json_body().get("rememberMe", False)
+    except (ValueError, AttributeError):
+        remember_me = False
 
     if not auth or not auth.username or not auth.password:
         return make_response(({"error": "Hacen falta parámetros."}, 401))
 
-    user = mongo.db.users.find_one({"nick": auth.username})
+    user = mongo.db.users.find_one(
+        {"nick_cf": nick_key(auth.username), **NOT_PENDING}
+    )
 
     if user is None:
         return make_response(({"error": "Usuario no encontrado."}, 404))
@@ -167,18 +456,26 @@ def login(request):
     new_passwd_hash = None
 
     if user["password_from"] == "ergo":
-        current_app.logger.info("Cuenta creada directamente en el IRCd, se migrará contraseña")
+        logger.info("Cuenta creada directamente en el IRCd, se migrará contraseña")
         check_passwd_function = check_password_hash_ergo
-        new_passwd_hash = generate_password_hash(auth.password)
+        new_passwd_hash = hash_password(auth.password)
     else:
-        check_passwd_function = check_password_hash
+        check_passwd_function = verify_password
 
     if check_passwd_function(user["password"], auth.password):
         if new_passwd_hash is not None:
             mongo.db.users.update_one(
-                {"nick": auth.username},
-                {"$set": {"password": new_passwd_hash, "password_from": "supra"}},
+                {"_id": user["_id"]},
+                {
+                    "$set": {
+                        "password": new_passwd_hash,
+                        "password_from": "supra",
+                        "updated_at": dt.datetime.utcnow(),
+                    }
+                },
             )
+            evict_profile(user["_id"])
+        record_activity(user["_id"], login=True)
         exp = {"days": 30} if remember_me else {"minutes": 30}
         token = jwt.encode(
             {
@@ -196,10 +493,12 @@ def login(request):
             },
             current_app.config["SECRET_KEY"],
         )
-        current_app.logger.info(f"Usuario {user['nick']} inicia sesión | Sesión extendida: {remember_me}")
+        logger.info(
+            "Usuario %s inicia sesión | Sesión extendida: %s", user["nick"], remember_me
+        )
         return {"token": token}
     else:
-        current_app.logger.info(f"Inicio de sesión fallido por {user['nick']}")
+        logger.info("Inicio de sesión fallido por %s", user["nick"])
         return make_response(({"error": "Contraseña incorrecta"}, 401))
 
 
@@ -208,7 +507,7 @@ def update(current_user, args):
     about = args.get("about")
     password = args.get("password")
 
-    existing_user = mongo.db.users.find_one({"nick": current_user["nick"]})
+    existing_user = mongo.db.users.find_one({"_id": current_user["_id"]})
 
     if existing_user is None:
         return make_response(({"error": f"Usuario no encontrado."}, 404))
@@ -227,15 +526,17 @@ def update(current_user, args):
 
     if password:
         stored_pw_hash = existing_user["password"]
-        if not check_password_hash(stored_pw_hash, password):
-            fields_to_update["password"] = generate_password_hash(password)
+        if not verify_password(stored_pw_hash, password):
+            fields_to_update["password"] = hash_password(password)
 
     if len(fields_to_update.items()) == 0:
         return make_response(({"error": "Nada para modificar."}, 409))
 
     mongo.db.users.update_one(
-        {"nick": current_user["nick"]}, {"$set": {**fields_to_update}}
+        {"_id": existing_user["_id"]},
+        {"$set": {**fields_to_update, "updated_at": dt.datetime.utcnow()}},
     )
+    evict_profile(existing_user["_id"])
 
     response = {"nick": current_user["nick"], **fields_to_update}
 
@@ -1,10 +1,114 @@
+import datetime as dt
+import sys
+
 import click
+from flask import current_app, has_request_context, request
 from flask.cli import with_appcontext
 from flask_pymongo import PyMongo
-from pymongo import TEXT
+from pymongo import ASCENDING, ReadPreference, TEXT, UpdateOne
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from pymongo.read_preferences import make_read_preference, read_pref_mode_from_name
+
+from suprachat_backend.utils.casemapping import nick_key
 
 mongo = PyMongo()
 
+# Public profile reads can be served by a secondary; everything else, and in
+# particular the paths that read their own writes (update, login), uses the
+# primary. So does the delta sync: a lagging secondary would hand out a
+# watermark past changes it hasn't replicated yet, and they'd never be synced
+DEFAULT_READ_PREFERENCES = ",".join(
+    f"{endpoint}=secondaryPreferred"
+    for endpoint in ("users.users", "users.user", "users.users_batch")
+)
+
+# Signup reservations left behind by a crashed worker are removed after this
+RESERVATION_TTL = 600
+
+
+def connect(app):
+    """Creates the MongoDB client for 'app'. PyMongo doesn't open any connection
+    until the first operation, so this is safe to call before forking."""
+    mongo.init_app(app)
+
+
+def parse_read_preferences(value: str, max_staleness: int) -> dict:
+    """
+    Parses the per-endpoint read preferences from the app config.
+
+    Args:
+        value: Comma-separated pairs of endpoint and read preference mode, for
+            example 'users.users=secondaryPreferred,users.user=nearest'.
+        max_staleness: How far behind the primary, in seconds, a secondary can
+            be and still take reads. MongoDB won't take less than 90.
+
+    Returns:
+        A dict of endpoint to read preference. Endpoints not in it read from
+        the primary.
+    """
+    preferences = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            endpoint, name = (part.strip() for part in item.split("=", 1))
+            try:
+                mode = read_pref_mode_from_name(name)
+            except ValueError:
+                raise ValueError(f"Unknown read preference for {endpoint}: {name}")
+            preferences[endpoint] = (
+                ReadPreference.PRIMARY
+                if mode == ReadPreference.PRIMARY.mode
+                else make_read_preference(mode, None, max_staleness)
+            )
+    return preferences
+
+
+def read_collection(name: str):
+    """Returns collection 'name' with the read preference configured for the
+    endpoint being served. Paths that must read their own writes just don't
+    configure one, and use the primary."""
+    collection = mongo.db[name]
+    if has_request_context():
+        preference = current_app.extensions["read_preferences"].get(request.endpoint)
+        if preference is not None:
+            return collection.with_options(read_preference=preference)
+    return collection
+
+
+# Every index the app relies on, as collection, keys and options
+INDEXES = (
+    ("users", [("nick", TEXT)], {"unique": True}),
+    ("users", [("nick_cf", ASCENDING)], {"unique": True}),
+    (
+        "users",
+        [("email", ASCENDING)],
+        # Accounts imported from Ergo have no email
+        {"unique": True, "partialFilterExpression": {"email": {"$type": "string"}}},
+    ),
+    ("users", [("reserved_at", ASCENDING)], {"expireAfterSeconds": RESERVATION_TTL}),
+    # Serves delta syncs, and lets the invalidation bus poll for changed users
+    # without change streams
+    ("users", [("updated_at", ASCENDING), ("_id", ASCENDING)], {}),
+    ("upload_sessions", [("expires_at", ASCENDING)], {"expireAfterSeconds": 0}),
+)
+
+
+def ensure_indexes(db) -> list:
+    """
+    Creates the indexes in `INDEXES`. One the existing data doesn't allow, like
+    a unique index over duplicated emails or users without `nick_cf`, doesn't
+    keep the rest from being built.
+
+    Returns:
+        The errors of the indexes that couldn't be built.
+    """
+    errors = []
+    for collection, keys, options in INDEXES:
+        try:
+            db[collection].create_index(keys, **options)
+        except OperationFailure as e:
+            errors.append(f"{collection} {keys}: {e}")
+    return errors
+
 
 def init_db():
     db = mongo.db
@@ -14,7 +118,66 @@ def init_db():
         db.drop_collection(collection)
 
     db.create_collection("users")
-    db.users.create_index([("nick", TEXT)], unique=True)
+    ensure_indexes(db)
+
+
+def backfill_nick_cf(batch_size: int = 1000) -> int:
+    """
+    Sets `nick_cf` on every user document that lacks it, or whose key was
+    computed with a different casemapping, and then builds the unique index
+    over it.
+
+    Args:
+        batch_size: How many documents to read per batch.
+
+    Returns:
+        The number of documents updated.
+    """
+    users = mongo.db.users
+    updated = 0
+    last_id = None
+
+    while True:
+        query = {}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        batch = list(
+            users.find(query, {"nick": True, "nick_cf": True})
+            .sort("_id", ASCENDING)
+            .limit(batch_size)
+        )
+        if not batch:
+            break
+
+        updates = []
+        for user in batch:
+            key = nick_key(user["nick"])
+            if user.get("nick_cf") != key:
+                updates.append(
+                    UpdateOne({"_id": user["_id"]}, {"$set": {"nick_cf": key}})
+                )
+        if updates:
+            users.bulk_write(updates, ordered=False)
+            updated += len(updates)
+            click.echo(f"Updated {updated} users...")
+        last_id = batch[-1]["_id"]
+
+    users.create_index([("nick_cf", ASCENDING)], unique=True)
+    return updated
+
+
+def backfill_updated_at() -> int:
+    """
+    Sets `updated_at` to the current time on every user document that lacks
+    it, so delta syncs (see `GET /api/v1/users/changes`) can see them.
+
+    Returns:
+        The number of documents updated.
+    """
+    return mongo.db.users.update_many(
+        {"updated_at": {"$exists": False}},
+        {"$set": {"updated_at": dt.datetime.utcnow()}},
+    ).modified_count
 
 
 @click.command("init-db")
@@ -24,5 +187,39 @@ def init_db_command():
     click.echo("Initialized the database.")
 
 
+@click.command("backfill-nick-cf")
+@click.option("--batch-size", default=1000, show_default=True)
+@with_appcontext
+def backfill_nick_cf_command(batch_size):
+    try:
+        updated = backfill_nick_cf(batch_size)
+    except DuplicateKeyError as e:
+        click.echo(f"Some nicks collide once casefolded, fix them first: {e}")
+        sys.exit(1)
+    click.echo(f"Backfilled nick_cf on {updated} users.")
+
+
+@click.command("backfill-updated-at")
+@with_appcontext
+def backfill_updated_at_command():
+    updated = backfill_updated_at()
+    click.echo(f"Backfilled updated_at on {updated} users.")
+
+
 def init_app(app):
+    preferences = parse_read_preferences(
+        app.config["READ_PREFERENCES"], app.config["READ_MAX_STALENESS"]
+    )
+    changes = preferences.get("users.users_changes", ReadPreference.PRIMARY)
+    if (
+        changes.mode != ReadPreference.PRIMARY.mode
+        and app.config["CHANGES_SAFETY_LAG"] < app.config["READ_MAX_STALENESS"]
+    ):
+        raise ValueError(
+            "users.users_changes can only read from secondaries if "
+            "CHANGES_SAFETY_LAG is at least READ_MAX_STALENESS."
+        )
+    app.extensions["read_preferences"] = preferences
     app.cli.add_command(init_db_command)
+    app.cli.add_command(backfill_nick_cf_command)
+    app.cli.add_command(backfill_updated_at_command)
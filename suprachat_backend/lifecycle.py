@@ -0,0 +1,216 @@
+import os
+import threading
+import time
+import weakref
+
+from flask import current_app, json, request
+
+from suprachat_backend import db
+from suprachat_backend.models.user import user_schema
+
+
+# The request shapes sent by the frontend: signup and the profile form
+COMMON_USER_SCHEMAS = (
+    (frozenset({"nick", "email", "password"}), False),
+    (frozenset({"country", "about"}), True),
+    (frozenset({"country", "about", "password"}), True),
+    (frozenset({"password"}), True),
+)
+
+# Longest wait between two attempts to warm up a worker that failed to, in
+# seconds
+MAX_RETRY_BACKOFF = 60
+
+# Every app built by create_app, so a gunicorn hook can reach them after fork
+_apps = weakref.WeakSet()
+
+
+class WorkerThread:
+    """Base for the objects that run a background thread in every worker.
+
+    Threads don't survive a fork, so with `gunicorn --preload` whatever the
+    master started is gone in the workers. The thread is bound to the process
+    that started it, and starting again in a forked worker starts a new one.
+    """
+
+    pid = None
+    stopping = None
+    thread = None
+
+    @property
+    def started(self) -> bool:
+        """Whether the current process started the thread."""
+        return self.pid == os.getpid()
+
+    def start_thread(self, name: str, target, *args) -> bool:
+        """Runs 'target(*args)' on a daemon thread, unless the current process
+        already started one. Returns whether it did."""
+        if self.started:
+            return False
+        self.pid = os.getpid()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(
+            target=target, args=args, name=name, daemon=True
+        )
+        self.thread.start()
+        return True
+
+    @property
+    def running(self) -> bool:
+        """Whether the thread of the current process is alive and hasn't been
+        asked to stop."""
+        return (
+            self.started and self.thread.is_alive() and not self.stopping.is_set()
+        )
+
+    def stop_thread(self, timeout: float) -> bool:
+        """Sets `stopping` and waits up to 'timeout' seconds for the thread to
+        finish. Returns False if the current process has none running."""
+        if not self.started or self.stopping.is_set():
+            return False
+        self.stopping.set()
+        self.thread.join(timeout)
+        return True
+
+
+class Lifecycle:
+    """Keeps track of whether the per-process state of an app is warmed up.
+
+    With `gunicorn --preload` the app is created once in the master process and
+    then forked, so the state is bound to the process that warmed it up.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.warmed_at = None
+        self.error = None
+        # Indexes the data doesn't allow, see db.ensure_indexes
+        self.index_errors = []
+        self.failures = 0
+        self.retry_at = 0
+        # Keeps trying to warm up in the background until it works
+        self.retrier = WorkerThread()
+
+    @property
+    def ready(self) -> bool:
+        return self.pid == os.getpid() and self.error is None
+
+    @property
+    def due(self) -> bool:
+        """Whether this process should try to warm up now: it hasn't tried yet,
+        or the backoff after its last failure is over."""
+        return self.pid != os.getpid() or time.monotonic() >= self.retry_at
+
+    def wait(self) -> float:
+        """Seconds until the next attempt is due."""
+        return 0 if self.due else max(self.retry_at - time.monotonic(), 0)
+
+
+def warmup(app):
+    """
+    Prepares the per-process state of 'app' so the first requests served by a
+    fresh worker don't pay for it: starts the background threads, opens the
+    MongoDB connection pool, checks the indexes and builds the objects that are
+    otherwise created lazily. Indexes that can't be built are reported in
+    `index_errors` but don't make the warmup fail.
+
+    Does nothing if this process is already warmed up, or if it failed to
+    and the backoff before the next attempt isn't over.
+    """
+    state = app.extensions["lifecycle"]
+    app.extensions["log_pipeline"].start()
+    with state.lock:
+        if state.ready or not state.due:
+            return
+        try:
+            with app.app_context():
+                # These cope with MongoDB being unreachable on their own, so
+                # they run whatever happens to the rest
+                users = db.mongo.db.users
+                app.extensions["registered_nicks"].start(app, users)
+                app.extensions["activity"].start(app, users)
+                app.extensions["invalidation_bus"].start(app, users)
+                app.extensions["presence"].start(app, users)
+                for fields, partial in COMMON_USER_SCHEMAS:
+                    user_schema(fields, partial)
+                json.dumps({"warmup": True, "at": time.time()})
+                state.index_errors = db.ensure_indexes(db.mongo.db)
+                for error in state.index_errors:
+                    app.logger.error("No se pudo crear el índice %s", error)
+        except Exception as e:
+            if state.pid != os.getpid():
+                state.failures = 0
+            state.pid = os.getpid()
+            state.error = str(e)
+            state.retry_at = time.monotonic() + min(
+                2**state.failures, MAX_RETRY_BACKOFF
+            )
+            state.failures += 1
+            app.logger.error("Falló el calentamiento del worker %s: %s", state.pid, e)
+            return
+        state.pid = os.getpid()
+        state.error = None
+        state.failures = 0
+        state.warmed_at = time.time()
+        app.logger.info("Worker %s listo", state.pid)
+
+
+def _retry_warmup(app):
+    state = app.extensions["lifecycle"]
+    while not state.ready:
+        if state.retrier.stopping.wait(state.wait()):
+            return
+        warmup(app)
+
+
+def retry_warmup(app):
+    """Warms up 'app' on a background thread, retrying with a backoff until it
+    works. Nothing else has to arrive for a worker that failed to warm up,
+    e.g. while MongoDB was unreachable, to become ready."""
+    state = app.extensions["lifecycle"]
+    if not state.ready:
+        state.retrier.start_thread("warmup", _retry_warmup, app)
+
+
+def post_fork():
+    """Replaces the MongoDB clients inherited from the parent process and warms
+    up every app. Meant to be called from gunicorn's `post_worker_init` hook."""
+    for app in list(_apps):
+        db.connect(app)
+        warmup(app)
+        retry_warmup(app)
+
+
+def shutdown():
+    """Flushes the buffered state of every app before the worker exits. Meant
+    to be called from gunicorn's `worker_exit` hook."""
+    for app in list(_apps):
+        app.extensions["lifecycle"].retrier.stop_thread(1)
+        app.extensions["presence"].stop()
+        app.extensions["registered_nicks"].stop()
+        app.extensions["invalidation_bus"].stop()
+        app.extensions["activity"].stop(app, db.mongo.db.users)
+        app.extensions["log_pipeline"].stop()
+
+
+def _warmup_on_first_request():
+    # Covers servers that don't call post_fork (the Flask dev server, the test
+    # client or gunicorn without the config file). Health checks must stay
+    # cheap even if MongoDB is down, so they leave it to the background, and
+    # so do the requests that arrive before a failed attempt can be retried.
+    # Nothing is started before the first request, that could still be in
+    # gunicorn's master process
+    state = current_app.extensions["lifecycle"]
+    if state.ready:
+        return
+    app = current_app._get_current_object()
+    if request.endpoint not in ("health.health", "health.ready") and state.due:
+        warmup(app)
+    retry_warmup(app)
+
+
+def init_app(app):
+    app.extensions["lifecycle"] = Lifecycle()
+    app.before_request(_warmup_on_first_request)
+    _apps.add(app)
@@ -1,7 +1,9 @@
-import json
+from functools import lru_cache
 
 from marshmallow import Schema, fields, validate
 
+from suprachat_backend.utils.body import json_body
+
 
 class UserSchema(Schema):
     nick = fields.Str(validate=validate.Length(min=3), required=True)
@@ -11,7 +13,23 @@ class UserSchema(Schema):
     about = fields.Str(validate=validate.Length(max=300), required=False)
 
 
+USER_FIELDS = frozenset(UserSchema._declared_fields)
+
+
+@lru_cache(maxsize=2 ** len(USER_FIELDS) * 2)
+def user_schema(fields: frozenset, partial: bool) -> UserSchema:
+    """Returns a shared UserSchema limited to 'fields'. Schemas hold no
+    per-request state, so one instance per shape is enough."""
+    return UserSchema(only=fields, partial=partial)
+
+
 def make_user_schema(request):
-    fields = json.loads(request.data).keys()
-    partial = request.method == "PATCH"
-    return UserSchema(only=fields, partial=partial, context={"request": request})
+    try:
+        body = json_body()
+    except ValueError:
+        # Let webargs reject the body when it tries to load it
+        body = None
+    keys = body.keys() if isinstance(body, dict) else ()
+    # Unknown keys are left out of `only` so they fail validation as unknown
+    # fields, which also keeps the number of cached shapes bounded
+    return user_schema(USER_FIELDS.intersection(keys), request.method == "PATCH")
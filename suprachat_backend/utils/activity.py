@@ -0,0 +1,131 @@
+import atexit
+import datetime as dt
+import threading
+import time
+
+from flask import current_app
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+
+from suprachat_backend.lifecycle import WorkerThread
+
+
+# The fields the buffer writes
+ACTIVITY_FIELDS = ("last_login", "last_seen")
+
+
+class ActivityBuffer(WorkerThread):
+    """A per-worker write-behind buffer for the `last_login` and `last_seen`
+    timestamps of users.
+
+    Recording activity only touches a dict; a background thread writes the
+    latest timestamps of every user as a single unordered bulk write every
+    'flush_interval' seconds. `$max` is used so a late flush from another
+    worker can never move a timestamp backwards.
+    """
+
+    def __init__(self, max_pending: int = 10000, flush_interval: float = 5.0):
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self.pending: dict = {}
+        self.lock = threading.Lock()
+        self.oldest = None
+        self.dropped = 0
+        self.flushed = 0
+        self.failed = 0
+
+    def record(self, user_id, login: bool = False):
+        """Records that 'user_id' has just been active, or logged in."""
+        now = dt.datetime.utcnow()
+        with self.lock:
+            entry = self.pending.get(user_id)
+            if entry is None:
+                if len(self.pending) >= self.max_pending:
+                    self.dropped += 1
+                    return
+                entry = self.pending[user_id] = {}
+                if self.oldest is None:
+                    self.oldest = time.monotonic()
+            entry["last_seen"] = now
+            if login:
+                entry["last_login"] = now
+
+    def flush(self, users) -> int:
+        """Writes every pending timestamp to 'users' and returns how many
+        users were updated."""
+        with self.lock:
+            batch, self.pending = self.pending, {}
+            self.oldest = None
+        if not batch:
+            return 0
+
+        try:
+            users.bulk_write(
+                [
+                    UpdateOne({"_id": user_id}, {"$max": fields})
+                    for user_id, fields in batch.items()
+                ],
+                ordered=False,
+            )
+        except PyMongoError:
+            self.failed += len(batch)
+            # Put the batch back for the next flush, newer timestamps win
+            with self.lock:
+                for user_id, fields in batch.items():
+                    entry = self.pending.get(user_id)
+                    if entry is None:
+                        if len(self.pending) >= self.max_pending:
+                            self.dropped += 1
+                            continue
+                        self.pending[user_id] = fields
+                    else:
+                        for key, value in fields.items():
+                            entry[key] = max(entry.get(key, value), value)
+                if self.oldest is None and self.pending:
+                    self.oldest = time.monotonic()
+            raise
+
+        self.flushed += len(batch)
+        return len(batch)
+
+    def stats(self) -> dict:
+        oldest = self.oldest
+        return {
+            "pending": len(self.pending),
+            "lag": 0 if oldest is None else round(time.monotonic() - oldest, 3),
+            "flushed": self.flushed,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+    def run(self, app, users):
+        while not self.stopping.wait(self.flush_interval):
+            try:
+                self.flush(users)
+            except PyMongoError as e:
+                app.logger.warning("No se pudo guardar la actividad: %s", e)
+
+    def start(self, app, users):
+        """Starts the flushing thread of the current process."""
+        if self.start_thread("activity-flusher", self.run, app, users):
+            atexit.register(self.stop, app, users)
+
+    def stop(self, app, users):
+        """Stops the flushing thread and writes whatever is still pending."""
+        if not self.stop_thread(self.flush_interval):
+            return
+        try:
+            self.flush(users)
+        except PyMongoError as e:
+            app.logger.warning("Se perdió la actividad pendiente: %s", e)
+
+
+def record_activity(user_id, login: bool = False):
+    """Records activity of 'user_id' in the buffer of the current app."""
+    current_app.extensions["activity"].record(user_id, login)
+
+
+def init_app(app):
+    app.extensions["activity"] = ActivityBuffer(
+        app.config["ACTIVITY_MAX_PENDING"], app.config["ACTIVITY_FLUSH_INTERVAL"]
+    )
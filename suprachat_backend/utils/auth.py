@@ -1,11 +1,15 @@
 from functools import wraps
+import logging
 
 from bson.objectid import ObjectId
 from flask import current_app, request
 import jwt
 from jwt.exceptions import InvalidTokenError
 
-from suprachat_backend.db import mongo
+from suprachat_backend.db import read_collection
+from suprachat_backend.utils.activity import record_activity
+
+logger = logging.getLogger(__name__)
 
 
 def token_required(f):
@@ -23,15 +27,16 @@ def token_required(f):
             data = jwt.decode(
                 token, current_app.config["SECRET_KEY"], algorithms=("HS256",)
             )
-            current_user = mongo.db.users.find_one(
+            current_user = read_collection("users").find_one(
                 {"_id": ObjectId(data["user"]["_id"])}
             )
             if current_user is None:
                 raise InvalidTokenError("Token is invalid, user does not exist.")
         except InvalidTokenError as e:
-            print(e)
+            logger.info("Token inválido: %s", e)
             return {"success": False, "error": "Invalid token"}
 
+        record_activity(current_user["_id"])
         return f(current_user, *args, **kwargs)
 
     return decorator
@@ -0,0 +1,43 @@
+import json
+
+from flask import g, request
+from webargs import core
+from webargs.flaskparser import FlaskParser, is_json_request
+
+
+def json_body():
+    """
+    Parses the body of the current request as JSON, only once per request; the
+    result is kept on `flask.g` for the schema factories, webargs and the
+    controllers to share.
+
+    Returns:
+        The decoded JSON document.
+
+    Raises:
+        ValueError: The body is not valid JSON (the same error is raised every
+            time it's asked for during the request).
+    """
+    if "json_body" not in g:
+        try:
+            g.json_body = json.loads(request.get_data(cache=True))
+        except ValueError as e:
+            g.json_body_error = e
+            g.json_body = None
+
+    if "json_body_error" in g:
+        raise g.json_body_error
+    return g.json_body
+
+
+class SingleParseFlaskParser(FlaskParser):
+    """A webargs parser that reads JSON bodies through `json_body`."""
+
+    def _raw_load_json(self, req):
+        if not is_json_request(req):
+            return core.missing
+        return json_body()
+
+
+parser = SingleParseFlaskParser()
+use_args = parser.use_args
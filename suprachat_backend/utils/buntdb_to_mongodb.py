@@ -9,6 +9,8 @@ from flask.cli import with_appcontext
 from pymongo import MongoClient
 from pymongo.errors import DuplicateKeyError
 
+from suprachat_backend.utils.casemapping import nick_key
+
 
 def find_users(file: str) -> list[dict]:
     """
@@ -88,6 +90,7 @@ def insert_into_mongo():
             users.insert_one(
                 {
                     "nick": user["nick"],
+                    "nick_cf": nick_key(user["nick"]),
                     "password": user["password_hash"],
                     "email": None,
                     "registered_date": user["registered_date"],
@@ -96,6 +99,7 @@ def insert_into_mongo():
                     "active": True,
                     "country": None,
                     "about": None,
+                    "updated_at": datetime.utcnow(),
                 }
             )
             inserted_users += 1
@@ -0,0 +1,82 @@
+from collections import OrderedDict
+import threading
+import time
+
+from flask import current_app
+
+
+class ProfileCache:
+    """A per-worker LRU cache of public profiles, keyed by `nick_cf`.
+
+    Entries can live for a long time because they are evicted as soon as the
+    user changes anywhere (see `utils.invalidation`). To avoid caching a
+    profile that was read right before it changed, readers take a token with
+    `begin` before querying MongoDB and pass it to `set`: if anything was
+    evicted in between, the profile isn't cached.
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.keys_by_id = {}
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def begin(self) -> int:
+        return self.generation
+
+    def get(self, key: str):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def set(self, key: str, user_id, profile: dict, token: int, ttl: float = None):
+        """Caches 'profile' for 'ttl' seconds, or the default TTL if None,
+        unless anything was evicted since 'token' was taken."""
+        if ttl is None or ttl > self.ttl:
+            ttl = self.ttl
+        with self.lock:
+            if token != self.generation:
+                return
+            self.entries[key] = (time.monotonic() + ttl, str(user_id), profile)
+            self.entries.move_to_end(key)
+            self.keys_by_id[str(user_id)] = key
+            while len(self.entries) > self.max_entries:
+                _, (_, old_id, _) = self.entries.popitem(last=False)
+                self.keys_by_id.pop(old_id, None)
+
+    def evict(self, user_id):
+        """Drops the profile of 'user_id', or every profile if it's None."""
+        with self.lock:
+            self.generation += 1
+            self.evictions += 1
+            if user_id is None:
+                self.entries.clear()
+                self.keys_by_id.clear()
+                return
+            key = self.keys_by_id.pop(str(user_id), None)
+            if key is not None:
+                self.entries.pop(key, None)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+def evict_profile(user_id):
+    """Drops the cached profile of 'user_id' in this worker right away. The
+    other workers hear about it from the invalidation bus."""
+    current_app.extensions["profile_cache"].evict(user_id)
@@ -0,0 +1,81 @@
+import unicodedata
+
+from flask import current_app
+
+
+CASEMAPPINGS = ("precis", "permissive", "ascii", "rfc1459", "rfc1459-strict")
+
+_ASCII_UPPER = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+_ASCII_LOWER = "abcdefghijklmnopqrstuvwxyz"
+
+_ASCII_TABLE = str.maketrans(_ASCII_UPPER, _ASCII_LOWER)
+_RFC1459_TABLE = str.maketrans(_ASCII_UPPER + "[]\\~", _ASCII_LOWER + "{}|^")
+_RFC1459_STRICT_TABLE = str.maketrans(_ASCII_UPPER + "[]\\", _ASCII_LOWER + "{}|")
+
+
+def _map_width(name: str) -> str:
+    """Maps fullwidth and halfwidth code points to their decomposition, which is
+    the PRECIS width mapping rule."""
+    return "".join(
+        unicodedata.normalize("NFKC", char)
+        if unicodedata.decomposition(char).startswith(("<wide>", "<narrow>"))
+        else char
+        for char in name
+    )
+
+
+def _fold_precis(name: str) -> str:
+    """Applies one pass of the PRECIS UsernameCaseMapped profile rules. Case is
+    mapped with toLowerCase, not full case folding, so 'Straße' and 'Strasse'
+    stay different names."""
+    return unicodedata.normalize("NFC", _map_width(name).lower())
+
+
+def _fold_permissive(name: str) -> str:
+    """Ergo's permissive casemapping: full Unicode case folding between two NFD
+    normalizations."""
+    return unicodedata.normalize("NFD", unicodedata.normalize("NFD", name).casefold())
+
+
+def casefold(name: str, casemapping: str = "precis") -> str:
+    """
+    Casefolds a nickname or account name the same way Ergo does, so two names
+    that Ergo considers equal produce the same key.
+
+    Args:
+        name: The nickname or account name to casefold.
+        casemapping: The value of `server.casemapping` in the ircd config, one
+            of CASEMAPPINGS. Default is 'precis'.
+
+    Raises:
+        ValueError: 'casemapping' isn't one of CASEMAPPINGS.
+
+    Returns:
+        The casefolded name, for example:
+
+            casefold("DeadOcean") == "deadocean"
+    """
+    if casemapping == "ascii":
+        return name.translate(_ASCII_TABLE)
+    if casemapping == "rfc1459":
+        return name.translate(_RFC1459_TABLE)
+    if casemapping == "rfc1459-strict":
+        return name.translate(_RFC1459_STRICT_TABLE)
+    if casemapping == "permissive":
+        return _fold_permissive(name)
+    if casemapping != "precis":
+        raise ValueError(f"Unknown casemapping: {casemapping}")
+
+    # A single PRECIS pass isn't guaranteed to be idempotent, Ergo repeats it
+    # up to four times until the result stabilizes
+    folded = name
+    for _ in range(4):
+        name, folded = folded, _fold_precis(folded)
+        if name == folded:
+            break
+    return folded
+
+
+def nick_key(nick: str) -> str:
+    """Returns the `nick_cf` key for 'nick' using the app's configured casemapping."""
+    return casefold(nick, current_app.config["CASEMAPPING"])
@@ -0,0 +1,85 @@
+import queue
+import threading
+
+
+# Sent to every subscription when changes may have been missed
+RESET = object()
+
+
+class Subscription:
+    """The events waiting to be sent to one client. 'keys' holds the casefolded
+    nicks the client is interested in, or None for everybody."""
+
+    def __init__(self, keys, max_queued: int):
+        self.keys = keys
+        self.queue = queue.Queue(max_queued)
+        self.overflowed = False
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            # A client this far behind has to reconnect and replay
+            self.overflowed = True
+
+
+class EventHub:
+    """Fans the changes reported by the invalidation bus out to the event
+    streams open in this worker.
+
+    Publishing never blocks: every stream has its own bounded queue, and a
+    stream whose client can't keep up is flagged instead.
+    """
+
+    def __init__(self, max_streams: int = 1000, max_queued: int = 100):
+        self.max_streams = max_streams
+        self.max_queued = max_queued
+        self.subscriptions = set()
+        self.lock = threading.Lock()
+        self.published = 0
+        self.overflows = 0
+
+    def subscribe(self, keys=None):
+        """Returns a new subscription, or None if this worker already serves
+        as many streams as it can."""
+        with self.lock:
+            if len(self.subscriptions) >= self.max_streams:
+                return None
+            subscription = Subscription(keys, self.max_queued)
+            self.subscriptions.add(subscription)
+            return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions.discard(subscription)
+            if subscription.overflowed:
+                self.overflows += 1
+
+    def publish(self, user_id, document):
+        """Invalidation bus listener, see `InvalidationBus.subscribe`."""
+        if user_id is None:
+            event, key = RESET, None
+        elif document is None or document.get("pending"):
+            return
+        else:
+            event, key = document, document.get("nick_cf")
+
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+        self.published += 1
+        for subscription in subscriptions:
+            if event is RESET or subscription.keys is None or key in subscription.keys:
+                subscription.put(event)
+
+    def stats(self) -> dict:
+        return {
+            "streams": len(self.subscriptions),
+            "published": self.published,
+            "overflows": self.overflows,
+        }
+
+
+def init_app(app):
+    hub = EventHub(app.config["EVENTS_MAX_STREAMS"], app.config["EVENTS_MAX_QUEUED"])
+    app.extensions["invalidation_bus"].subscribe(hub.publish)
+    app.extensions["events"] = hub
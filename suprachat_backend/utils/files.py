@@ -1,5 +1,37 @@
 ALLOWED_FILETYPES = {"png", "jpg", "jpeg", "gif", "webp"}
 
+# Leading bytes of each allowed image format, and the extension to save it with
+IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpg"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+)
+
+# How many bytes sniff_image_type needs to tell every format apart
+SNIFF_SIZE = 12
+
 
 def allowed_filename(filename: str):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_FILETYPES
+
+
+def sniff_image_type(head: bytes):
+    """
+    Identifies an image by its magic bytes instead of trusting its filename.
+
+    Args:
+        head: The first SNIFF_SIZE bytes of the file (or all of it, if shorter).
+
+    Returns:
+        The extension to save the image with, or None if it isn't one of
+        ALLOWED_FILETYPES. For example:
+
+            sniff_image_type(b"\\x89PNG\\r\\n\\x1a\\n...") == "png"
+    """
+    for signature, extension in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return extension
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    return None
@@ -0,0 +1,169 @@
+import datetime as dt
+
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure, PyMongoError
+
+from suprachat_backend.lifecycle import WorkerThread
+from suprachat_backend.utils.activity import ACTIVITY_FIELDS
+from suprachat_backend.utils.cache import ProfileCache
+
+
+# Error codes MongoDB answers with when change streams aren't available: the
+# server isn't part of a replica set, or the resume token is no longer in the
+# oplog
+CHANGE_STREAM_UNSUPPORTED = (40573,)
+CHANGE_STREAM_HISTORY_LOST = (136, 280, 286)
+
+# Updates that only touch these fields don't change anything anybody caches:
+# profiles are cached without them, see controllers.user._get_profiles
+IGNORED_FIELDS = list(ACTIVITY_FIELDS)
+
+_UPDATED_FIELDS = {
+    "$map": {
+        "input": {"$objectToArray": "$updateDescription.updatedFields"},
+        "in": "$$this.k",
+    }
+}
+
+# Skip the update events that only touch IGNORED_FIELDS, e.g. activity flushes
+PIPELINE = [
+    {
+        "$match": {
+            "$or": [
+                {"operationType": {"$ne": "update"}},
+                {"updateDescription.removedFields.0": {"$exists": True}},
+                {
+                    "$expr": {
+                        "$gt": [
+                            {
+                                "$size": {
+                                    "$setDifference": [_UPDATED_FIELDS, IGNORED_FIELDS]
+                                }
+                            },
+                            0,
+                        ]
+                    }
+                },
+            ]
+        }
+    }
+]
+
+# Writes from other workers may land slightly out of `updated_at` order, so
+# each poll looks this far behind the last change it saw
+POLL_OVERLAP = dt.timedelta(seconds=2)
+
+
+class InvalidationBus(WorkerThread):
+    """Tells every listener of this worker which users changed, no matter which
+    worker changed them.
+
+    Changes are read from a change stream on `users`. When the server doesn't
+    support change streams (a standalone mongod), the bus falls back to polling
+    the `updated_at` field every 'poll_interval' seconds. Either way, activity
+    flushes aren't reported.
+
+    Listeners are called from the bus thread with the id of the changed user
+    and the document after the change (None if it was deleted). A user id of
+    None means changes may have been missed and everything is suspect.
+    """
+
+    def __init__(self, poll_interval: float = 2.0):
+        self.poll_interval = poll_interval
+        self.listeners = []
+        self.mode = None
+        self.resume_token = None
+        self.watermark = None
+        self.changes = 0
+        self.errors = 0
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def dispatch(self, user_id, document):
+        self.changes += 1
+        for listener in self.listeners:
+            listener(user_id, document)
+
+    def _watch(self, users):
+        with users.watch(
+            PIPELINE,
+            full_document="updateLookup",
+            resume_after=self.resume_token,
+            max_await_time_ms=int(self.poll_interval * 1000),
+        ) as stream:
+            self.mode = "change_stream"
+            while not self.stopping.is_set():
+                change = stream.try_next()
+                self.resume_token = stream.resume_token
+                if change is not None:
+                    self.dispatch(
+                        change["documentKey"]["_id"], change.get("fullDocument")
+                    )
+
+    def _poll(self, users):
+        self.mode = "polling"
+        if self.watermark is None:
+            self.watermark = dt.datetime.utcnow()
+        seen = set()
+        while True:
+            since = self.watermark - POLL_OVERLAP
+            recent = set()
+            for user in users.find({"updated_at": {"$gt": since}}).sort(
+                "updated_at", ASCENDING
+            ):
+                change = (user["_id"], user["updated_at"])
+                recent.add(change)
+                if change in seen:
+                    continue
+                self.watermark = max(self.watermark, user["updated_at"])
+                self.dispatch(user["_id"], user)
+            seen = recent
+            if self.stopping.wait(self.poll_interval):
+                return
+
+    def run(self, app, users):
+        backoff = 1
+        while not self.stopping.is_set():
+            try:
+                if self.mode == "polling":
+                    self._poll(users)
+                else:
+                    self._watch(users)
+                backoff = 1
+            except OperationFailure as e:
+                if e.code in CHANGE_STREAM_UNSUPPORTED:
+                    app.logger.info("Sin change streams, se usará polling: %s", e)
+                    self.mode = "polling"
+                    continue
+                if e.code in CHANGE_STREAM_HISTORY_LOST:
+                    # Whatever happened in between is gone, start over clean
+                    self.resume_token = None
+                    self.dispatch(None, None)
+                self.errors += 1
+                app.logger.warning("Error en el bus de invalidación: %s", e)
+            except PyMongoError as e:
+                self.errors += 1
+                app.logger.warning("Error en el bus de invalidación: %s", e)
+            self.stopping.wait(backoff)
+            backoff = min(backoff * 2, 30)
+
+    def start(self, app, users):
+        """Starts the bus thread of the current process."""
+        self.start_thread("invalidation-bus", self.run, app, users)
+
+    def stop(self):
+        self.stop_thread(self.poll_interval + 1)
+
+    def stats(self) -> dict:
+        return {"mode": self.mode, "changes": self.changes, "errors": self.errors}
+
+
+def init_app(app):
+    cache = ProfileCache(
+        app.config["PROFILE_CACHE_SIZE"], app.config["PROFILE_CACHE_TTL"]
+    )
+    bus = InvalidationBus(app.config["INVALIDATION_POLL_INTERVAL"])
+    bus.subscribe(lambda user_id, document: cache.evict(user_id))
+    app.extensions["profile_cache"] = cache
+    app.extensions["invalidation_bus"] = bus
@@ -0,0 +1,219 @@
+import atexit
+import datetime as dt
+import json
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import os
+import queue
+import random
+import re
+import sys
+from uuid import uuid4
+
+from flask import g, has_request_context, request
+from flask.logging import default_handler
+
+
+# Attributes every LogRecord has; anything else was passed through `extra` and
+# ends up as a field of the JSON record
+_RECORD_ATTRS = frozenset(
+    logging.LogRecord("", 0, "", 0, "", (), None).__dict__.keys()
+) | {"message", "request_id"}
+
+_REDACTIONS = (
+    # Authorization headers and the objects werkzeug builds from them
+    (re.compile(r"(?i)\b(basic|bearer)\s+[A-Za-z0-9+/=._-]+"), r"\1 [REDACTED]"),
+    # JWTs
+    (re.compile(r"\beyJ[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+\.[A-Za-z0-9_-]*"), "[REDACTED]"),
+    # password=..., "password": "...", 'access_token': '...' and the like, but
+    # not keys that merely contain one of these, like postcode or error_code
+    (
+        re.compile(
+            r"""(?i)(["']?\b(?:(?:\w+_)?(?:password|passwd|token|secret)|code)\b"""
+            r"""["']?\s*[:=]\s*)(["']?)[^"',}\s]+\2"""
+        ),
+        r"\1\2[REDACTED]\2",
+    ),
+)
+
+_REQUEST_ID = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+
+def redact(text: str) -> str:
+    """Masks the credentials found in 'text'."""
+    for pattern, replacement in _REDACTIONS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats records as one JSON document per line, with credentials
+    redacted from the message and the extra fields."""
+
+    def format(self, record):
+        document = {
+            "time": dt.datetime.fromtimestamp(
+                record.created, dt.timezone.utc
+            ).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": redact(record.getMessage()),
+            "request_id": getattr(record, "request_id", None),
+            "pid": record.process,
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                document[key] = redact(value) if isinstance(value, str) else value
+        if record.exc_info:
+            document["exc_info"] = redact(self.formatException(record.exc_info))
+        return json.dumps(document, default=str, ensure_ascii=False)
+
+
+class RequestIdFilter(logging.Filter):
+    """Tags records with the id of the request being served. It runs on the
+    request thread, the listener has no request context."""
+
+    def filter(self, record):
+        record.request_id = g.get("request_id") if has_request_context() else None
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps only a fraction of the records at INFO level or below for the
+    loggers in 'rates', a mapping of logger name to the fraction to keep.
+    Rates apply to child loggers too."""
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = rates
+
+    def _rate(self, name: str):
+        while name:
+            if name in self.rates:
+                return self.rates[name]
+            name = name.rpartition(".")[0]
+        return None
+
+    def filter(self, record):
+        if record.levelno > logging.INFO:
+            return True
+        rate = self._rate(record.name)
+        return rate is None or random.random() < rate
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """A QueueHandler that never blocks or formats on the request thread: the
+    record is queued as is, and dropped (and counted) if the queue is full."""
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The stock QueueHandler formats the message here so the record can be
+        # pickled, which isn't needed by an in-process queue
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogPipeline:
+    """The queue, the request-side handler and the background listener that
+    does the formatting and the I/O."""
+
+    def __init__(self, sink: logging.Handler, max_queued: int):
+        self.sink = sink
+        self.max_queued = max_queued
+        self.handler = NonBlockingQueueHandler(queue.Queue(max_queued))
+        self.listener = None
+        self.running = False
+        self.pid = None
+        # The process the queue belongs to
+        self.queue_pid = os.getpid()
+        atexit.register(self.stop)
+
+    def start(self):
+        """Starts the listener thread of the current process, bound to it like
+        a `lifecycle.WorkerThread`. The queue's locks might not survive a fork
+        either, so a forked worker gets a new queue too."""
+        if self.pid == os.getpid():
+            return
+        if self.queue_pid != os.getpid():
+            self.handler.queue = queue.Queue(self.max_queued)
+            self.queue_pid = os.getpid()
+        self.pid = os.getpid()
+        self.listener = QueueListener(
+            self.handler.queue, self.sink, respect_handler_level=True
+        )
+        self.listener.start()
+        self.running = True
+
+    def stop(self):
+        """Writes out whatever is still queued and stops the listener."""
+        if self.pid == os.getpid():
+            if self.running:
+                self.running = False
+                self.listener.stop()
+        elif self.queue_pid == os.getpid():
+            # Never started here, e.g. by a CLI command, so nobody else will
+            while True:
+                try:
+                    record = self.handler.queue.get_nowait()
+                except queue.Empty:
+                    break
+                self.sink.handle(record)
+
+
+def _parse_sampling(value: str) -> dict:
+    rates = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            name, rate = item.split("=", 1)
+            rates[name.strip()] = float(rate)
+    return rates
+
+
+def _assign_request_id():
+    request_id = request.headers.get("X-Request-ID", "")
+    g.request_id = request_id if _REQUEST_ID.match(request_id) else uuid4().hex
+
+
+def _send_request_id(response):
+    response.headers["X-Request-ID"] = g.get("request_id", "")
+    return response
+
+
+# The app logger is shared by every app in the process, so is its pipeline
+_pipeline = None
+
+
+def init_app(app):
+    global _pipeline
+
+    sink = logging.StreamHandler(sys.stderr)
+    sink.setFormatter(JSONFormatter())
+
+    pipeline = LogPipeline(sink, app.config["LOG_QUEUE_SIZE"])
+    pipeline.handler.addFilter(RequestIdFilter())
+    pipeline.handler.addFilter(
+        SamplingFilter(_parse_sampling(app.config["LOG_SAMPLING"]))
+    )
+
+    if _pipeline is not None:
+        app.logger.removeHandler(_pipeline.handler)
+        _pipeline.stop()
+    _pipeline = pipeline
+
+    app.logger.removeHandler(default_handler)
+    app.logger.addHandler(pipeline.handler)
+    app.logger.setLevel(app.config["LOG_LEVEL"])
+    # Records wait in the queue until the worker is warmed up, which starts
+    # the listener, see lifecycle.warmup
+    app.extensions["log_pipeline"] = pipeline
+
+    app.before_request(_assign_request_id)
+    app.after_request(_send_request_id)
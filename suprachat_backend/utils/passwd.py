@@ -1,6 +1,42 @@
 import base64
 import json
 import subprocess
+import sys
+
+from werkzeug import security
+
+
+def _offload(function, *args):
+    """
+    Runs 'function(*args)' on the native thread pool of gevent or eventlet
+    when the worker is one of theirs, so a CPU-bound call (PBKDF2 hashing
+    takes a good fraction of a second) doesn't stall every other greenlet of
+    the worker, e.g. the open event streams. hashlib releases the GIL while
+    hashing, so it runs alongside them. Anywhere else it's a plain call.
+    """
+    if "gevent" in sys.modules:
+        from gevent import get_hub, monkey
+
+        if monkey.is_module_patched("threading"):
+            return get_hub().threadpool.apply(function, args)
+    if "eventlet" in sys.modules:
+        from eventlet import patcher, tpool
+
+        if patcher.is_monkey_patched("thread"):
+            return tpool.execute(function, *args)
+    return function(*args)
+
+
+def hash_password(password: str) -> str:
+    """Hashes 'password' with werkzeug's default method, off the event loop.
+    See `_offload`."""
+    return _offload(security.generate_password_hash, password)
+
+
+def verify_password(password_hash: str, password: str) -> bool:
+    """Checks 'password' against a werkzeug hash, off the event loop. See
+    `_offload`."""
+    return _offload(security.check_password_hash, password_hash, password)
 
 
 def check_password_hash(password_hash: str, password: str) -> bool:
@@ -0,0 +1,260 @@
+import queue
+import random
+import socket
+import threading
+import time
+
+import irctokens
+from pymongo import DESCENDING
+from pymongo.errors import PyMongoError
+
+from suprachat_backend.lifecycle import WorkerThread
+from suprachat_backend.utils.casemapping import casefold
+
+
+# Longest list of targets sent in a single MONITOR command, keeps the line well
+# under the 512 bytes IRC allows
+MAX_TARGETS_LENGTH = 400
+
+# Replies to MONITOR, see https://ircv3.net/specs/extensions/monitor
+RPL_MONONLINE = "730"
+RPL_MONOFFLINE = "731"
+ERR_MONLISTFULL = "734"
+
+
+class PresenceObserver(WorkerThread):
+    """A long-lived IRC connection that keeps track of which registered users
+    are connected to the IRCd, using MONITOR.
+
+    The registered nicks are loaded from MongoDB when the connection is set up
+    and every 'resync_interval' seconds after that; nicks registered in
+    between are added as soon as the invalidation bus reports them. If the
+    IRCd limits how many nicks a client can monitor, the most recently seen
+    users are monitored first and `complete` is False.
+
+    Lookups are answered from memory and never touch the network. While
+    disconnected the state is unknown, see `connected`.
+    """
+
+    def __init__(
+        self,
+        nick: str,
+        host: str = "127.0.0.1",
+        port: int = 6667,
+        resync_interval: float = 300,
+    ):
+        self.nick = nick
+        self.host = host
+        self.port = port
+        self.resync_interval = resync_interval
+        self.casemapping = "precis"
+        self.lock = threading.Lock()
+        # Casefolded nick to nick, for every nick being monitored and for the
+        # ones that are online
+        self.watched = {}
+        self.online = {}
+        self.additions = queue.SimpleQueue()
+        self.limit = None
+        # Whether every registered user is being monitored
+        self.complete = True
+        self.connected = False
+        self.resync_at = 0
+        self.reconnects = 0
+        self.sock = None
+        self.encoder = None
+
+    def is_online(self, nick: str):
+        """Returns whether 'nick' is connected to the IRCd, or None if that's
+        unknown because it isn't being monitored."""
+        key = casefold(nick, self.casemapping)
+        with self.lock:
+            if not self.connected or key not in self.watched:
+                return None
+            return key in self.online
+
+    def online_nicks(self) -> list:
+        with self.lock:
+            return sorted(self.online.values(), key=str.lower)
+
+    def watch(self, nick: str):
+        """Starts monitoring 'nick' as soon as the observer thread gets to it.
+        Safe to call from any thread."""
+        self.additions.put(nick)
+
+    def _send(self, line):
+        self.encoder.push(line)
+        while self.encoder.pending():
+            self.encoder.pop(self.sock.send(self.encoder.pending()))
+
+    def _monitor(self, sign: str, nicks):
+        chunk = []
+        for nick in nicks:
+            if chunk and len(",".join([*chunk, nick])) > MAX_TARGETS_LENGTH:
+                self._send(irctokens.build("MONITOR", [sign, ",".join(chunk)]))
+                chunk = []
+            chunk.append(nick)
+        if chunk:
+            self._send(irctokens.build("MONITOR", [sign, ",".join(chunk)]))
+
+    def _add(self, nicks):
+        added = []
+        with self.lock:
+            for nick in nicks:
+                key = casefold(nick, self.casemapping)
+                if key in self.watched:
+                    continue
+                if self.limit is not None and len(self.watched) >= self.limit:
+                    self.complete = False
+                    break
+                self.watched[key] = nick
+                added.append(nick)
+        self._monitor("+", added)
+
+    def _resync(self, users):
+        query = users.find(
+            {"pending": {"$ne": True}}, {"nick": True, "nick_cf": True}
+        ).sort("last_seen", DESCENDING)
+        if self.limit is not None:
+            # One more than fits, to tell whether anybody is left out
+            query = query.limit(self.limit + 1)
+        users = list(query)
+        complete = self.limit is None or len(users) <= self.limit
+        wanted = {user["nick_cf"]: user["nick"] for user in users[: self.limit]}
+
+        removed = []
+        with self.lock:
+            self.complete = complete
+            for key in [key for key in self.watched if key not in wanted]:
+                removed.append(self.watched.pop(key))
+                self.online.pop(key, None)
+        self._monitor("-", removed)
+        self._add(wanted.values())
+
+    def _handle(self, line, app, users):
+        if line.command == "PING":
+            self._send(irctokens.build("PONG", line.params))
+        elif line.command == "433" and not self.connected:
+            # Another worker is already using the nick
+            self._send(
+                irctokens.build("NICK", [f"{self.nick}{random.randint(0, 9999)}"])
+            )
+        elif line.command == "005":
+            for token in line.params[1:-1]:
+                name, _, value = token.partition("=")
+                if name == "MONITOR":
+                    self.limit = int(value) if value else None
+        elif line.command in ("376", "422"):
+            # End of the welcome burst, ISUPPORT is known by now
+            with self.lock:
+                self.connected = True
+            self._resync(users)
+            self.resync_at = time.monotonic() + self.resync_interval
+            app.logger.info(
+                "Observador de presencia conectado, vigilando %s nicks",
+                len(self.watched),
+            )
+        elif line.command == RPL_MONONLINE:
+            with self.lock:
+                for mask in line.params[-1].split(","):
+                    nick = irctokens.hostmask(mask).nickname
+                    self.online[casefold(nick, self.casemapping)] = nick
+        elif line.command == RPL_MONOFFLINE:
+            with self.lock:
+                for nick in line.params[-1].split(","):
+                    self.online.pop(casefold(nick, self.casemapping), None)
+        elif line.command == ERR_MONLISTFULL:
+            app.logger.warning(
+                "La lista de MONITOR está llena (%s), no se vigilan: %s",
+                line.params[1],
+                line.params[2],
+            )
+            with self.lock:
+                self.complete = False
+                for nick in line.params[2].split(","):
+                    self.watched.pop(casefold(nick, self.casemapping), None)
+        elif line.command == "ERROR":
+            raise ConnectionError(line.params[-1] if line.params else "ERROR")
+
+    def _session(self, app, users):
+        decoder = irctokens.StatefulDecoder()
+        self.encoder = irctokens.StatefulEncoder()
+        self.sock = socket.create_connection((self.host, self.port), timeout=10)
+        with self.sock:
+            # Short reads so the thread notices when it has to stop
+            self.sock.settimeout(1)
+            self._send(irctokens.build("NICK", [self.nick]))
+            self._send(irctokens.build("USER", [self.nick, "0", "*", self.nick]))
+            while not self.stopping.is_set():
+                if self.connected:
+                    if time.monotonic() >= self.resync_at:
+                        self._resync(users)
+                        self.resync_at = time.monotonic() + self.resync_interval
+                    nicks = []
+                    while not self.additions.empty():
+                        nicks.append(self.additions.get())
+                    self._add(nicks)
+
+                try:
+                    data = self.sock.recv(4096)
+                except socket.timeout:
+                    continue
+                lines = decoder.push(data)
+                if lines is None:
+                    raise ConnectionError("Disconnected from IRC server.")
+                for line in lines:
+                    self._handle(line, app, users)
+            self._send(irctokens.build("QUIT"))
+
+    def run(self, app, users):
+        backoff = 1
+        while not self.stopping.is_set():
+            try:
+                self._session(app, users)
+            except (OSError, PyMongoError) as e:
+                app.logger.warning("Observador de presencia desconectado: %s", e)
+            if self.connected:
+                backoff = 1
+            with self.lock:
+                self.connected = False
+                self.watched.clear()
+                self.online.clear()
+            self.reconnects += 1
+            self.stopping.wait(backoff)
+            backoff = min(backoff * 2, 60)
+
+    def start(self, app, users):
+        """Starts the observer thread of the current process."""
+        self.casemapping = app.config["CASEMAPPING"]
+        self.start_thread("presence", self.run, app, users)
+
+    def stop(self):
+        self.stop_thread(2)
+
+    def stats(self) -> dict:
+        return {
+            "connected": self.connected,
+            "watched": len(self.watched),
+            "online": len(self.online),
+            "limit": self.limit,
+            "complete": self.complete,
+            "reconnects": self.reconnects,
+        }
+
+
+def _watch_new_users(observer):
+    def listener(user_id, document):
+        if document is not None and not document.get("pending"):
+            observer.watch(document["nick"])
+
+    return listener
+
+
+def init_app(app):
+    observer = PresenceObserver(
+        app.config["PRESENCE_NICK"],
+        app.config["IRC_HOST"],
+        app.config["IRC_PORT"],
+        app.config["PRESENCE_RESYNC_INTERVAL"],
+    )
+    app.extensions["invalidation_bus"].subscribe(_watch_new_users(observer))
+    app.extensions["presence"] = observer
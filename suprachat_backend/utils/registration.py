@@ -0,0 +1,209 @@
+import unicodedata
+
+from flask import current_app
+from pymongo.errors import PyMongoError
+import yaml
+
+from suprachat_backend.lifecycle import WorkerThread
+from suprachat_backend.utils.casemapping import casefold
+from suprachat_backend.utils.validate_string import validate_string
+
+
+# Nicks Ergo keeps for itself and its services, no matter the config
+RESTRICTED_NICKS = ("=scene=", "histserv", "chanserv", "nickserv", "hostserv")
+
+# Nicks whose profile URL, /api/v1/users/<nick>, is taken by another route
+ROUTE_NICKS = ("changes", "online")
+
+# Characters Ergo never accepts in a nick, and the ones a nick can't start with
+NAME_FORBIDDEN_CHARS = " ,*?.!@:"
+NAME_FORBIDDEN_FIRST_CHARS = "#~&@%+-"
+
+DEFAULT_NICKLEN = 32
+MAX_PASSPHRASE_LENGTH = 300
+
+# How soon the registered nicks are reloaded after a failed attempt, in seconds
+RETRY_INTERVAL = 5
+
+
+class RegistrationRules:
+    """The subset of Ergo's account registration rules that can be checked
+    without talking to the IRCd.
+
+    Every check returns None when the value is acceptable, or one of the error
+    codes in `utils.irc.REGISTER_ERRORS` that Ergo would have answered with.
+    """
+
+    def __init__(
+        self,
+        nicklen: int = DEFAULT_NICKLEN,
+        casemapping: str = "precis",
+        reserved_nicks=(),
+    ):
+        self.nicklen = nicklen
+        self.casemapping = casemapping
+        self.reserved_nicks = frozenset(
+            casefold(nick, casemapping)
+            for nick in (*RESTRICTED_NICKS, *ROUTE_NICKS, *reserved_nicks)
+        )
+
+    @classmethod
+    def from_ircd_config(cls, path: str, reserved_nicks=()):
+        """
+        Reads the rules from Ergo's config file.
+
+        Args:
+            path: The path to ircd.yaml.
+            reserved_nicks: Nicks to refuse on top of the ones Ergo restricts.
+        """
+        with open(path) as f:
+            config = yaml.safe_load(f) or {}
+
+        return cls(
+            nicklen=(config.get("limits") or {}).get("nicklen", DEFAULT_NICKLEN),
+            casemapping=(config.get("server") or {}).get("casemapping", "precis"),
+            reserved_nicks=reserved_nicks,
+        )
+
+    def _valid_characters(self, folded: str) -> bool:
+        ascii_only = self.casemapping in ("ascii", "rfc1459", "rfc1459-strict")
+        for char in folded:
+            if ord(char) < 0x80:
+                if not 0x21 <= ord(char) <= 0x7E:
+                    return False
+            elif ascii_only:
+                return False
+            # Outside of ASCII, PRECIS identifiers only take letters, marks
+            # and digits
+            elif self.casemapping == "precis":
+                if unicodedata.category(char)[0] not in "LMN":
+                    return False
+        return True
+
+    def check_nick(self, nick: str):
+        """Checks 'nick' against Ergo's nick length limit, casemapping and
+        reserved names, plus our own forbidden characters (see
+        `validate_string`)."""
+        if not nick or len(nick.encode("utf-8")) > self.nicklen:
+            return "INVALID_USERNAME"
+
+        folded = casefold(nick, self.casemapping)
+        if (
+            not validate_string(nick)
+            or not self._valid_characters(folded)
+            or any(char in NAME_FORBIDDEN_CHARS for char in folded)
+            or folded[0] in NAME_FORBIDDEN_FIRST_CHARS
+        ):
+            return "INVALID_USERNAME"
+
+        if folded in self.reserved_nicks:
+            return "DISALLOWED"
+
+        return None
+
+    def check_password(self, password: str):
+        """Checks 'password' the way Ergo validates passphrases: it has to fit
+        as a regular IRC parameter."""
+        if (
+            not password
+            or len(password) > MAX_PASSPHRASE_LENGTH
+            or password == "*"
+            or password.startswith(":")
+            or any(char.isspace() for char in password)
+        ):
+            return "INVALID_PASSWORD"
+        return None
+
+
+class RegisteredNicks(WorkerThread):
+    """A per-worker copy of the casefolded nicks already registered, reloaded
+    from MongoDB every 'ttl' seconds by a background thread. A hit means the
+    nick is taken; a miss is inconclusive, the database and Ergo still have the
+    last word."""
+
+    def __init__(self, ttl: float = 300):
+        self.ttl = ttl
+        self.nicks = frozenset()
+
+    def refresh(self, users):
+        # Pending signups are left out, like everywhere else (NOT_PENDING in
+        # controllers/user.py): a reservation that fails or expires would keep
+        # the nick taken here until the next reload
+        self.nicks = frozenset(
+            user["nick_cf"]
+            for user in users.find(
+                {"nick_cf": {"$exists": True}, "pending": {"$ne": True}},
+                {"nick_cf": True},
+            )
+        )
+
+    def add(self, folded_nick: str):
+        self.nicks = self.nicks | {folded_nick}
+
+    def __contains__(self, folded_nick: str) -> bool:
+        return folded_nick in self.nicks
+
+    def run(self, app, users):
+        while True:
+            try:
+                self.refresh(users)
+                wait = self.ttl
+            except PyMongoError as e:
+                app.logger.warning("No se pudieron recargar los nicks: %s", e)
+                wait = min(self.ttl, RETRY_INTERVAL)
+            if self.stopping.wait(wait):
+                return
+
+    def start(self, app, users):
+        """Starts the thread that loads the nicks and reloads them."""
+        self.start_thread("registered-nicks", self.run, app, users)
+
+    def stop(self):
+        self.stop_thread(1)
+
+
+def validate_registration(nick: str, password: str):
+    """
+    Rejects a signup that Ergo would refuse, before opening a connection to it.
+
+    Args:
+        nick: The nick to register.
+        password: The password for the new account.
+
+    Returns:
+        None if the signup may go ahead, or the error code from
+        `utils.irc.REGISTER_ERRORS` that Ergo would answer with, for example
+        'USERNAME_EXISTS'.
+    """
+    rules = current_app.extensions["registration_rules"]
+    error = rules.check_nick(nick) or rules.check_password(password)
+    if error is not None:
+        return error
+
+    if casefold(nick, rules.casemapping) in current_app.extensions["registered_nicks"]:
+        return "USERNAME_EXISTS"
+
+    return None
+
+
+def init_app(app):
+    reserved_nicks = [
+        nick.strip()
+        for nick in (app.config["RESERVED_NICKS"] or "").split(",")
+        if nick.strip()
+    ]
+    if app.config["ERGO_CONFIG"]:
+        rules = RegistrationRules.from_ircd_config(
+            app.config["ERGO_CONFIG"], reserved_nicks
+        )
+        # The IRCd's config is the source of truth for the casemapping
+        app.config["CASEMAPPING"] = rules.casemapping
+    else:
+        rules = RegistrationRules(
+            casemapping=app.config["CASEMAPPING"], reserved_nicks=reserved_nicks
+        )
+
+    app.extensions["registration_rules"] = rules
+    app.extensions["registered_nicks"] = RegisteredNicks(
+        app.config["REGISTERED_NICKS_TTL"]
+    )
@@ -0,0 +1,25 @@
+from contextlib import contextmanager
+import time
+
+
+class StageTimer:
+    """Measures how long each stage of a request takes, to be reported in the
+    logs and in a `Server-Timing` header."""
+
+    def __init__(self):
+        self.stages: list[tuple[str, float]] = []
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append((name, time.perf_counter() - start))
+
+    def server_timing(self) -> str:
+        """Returns the stages in the `Server-Timing` header format, for example:
+
+        validate;dur=0.05, reserve;dur=1.20
+        """
+        return ", ".join(f"{name};dur={secs * 1000:.2f}" for name, secs in self.stages)
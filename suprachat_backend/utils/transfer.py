@@ -0,0 +1,311 @@
+import datetime as dt
+import json
+import os
+import time
+
+import bson
+from bson import json_util
+from bson.errors import InvalidBSON
+import click
+from flask.cli import with_appcontext
+from pymongo import ASCENDING, ReplaceOne
+from pymongo.errors import BulkWriteError
+
+from suprachat_backend.db import mongo
+
+
+FORMATS = ("ndjson", "bson")
+
+# Lossless, so an export can be imported back without changing any type
+JSON_OPTIONS = json_util.CANONICAL_JSON_OPTIONS
+
+
+def _format_for(path: str, format: str) -> str:
+    if format is not None:
+        return format
+    return "bson" if path.endswith(".bson") else "ndjson"
+
+
+def _parse_json(value: str, name: str):
+    if not value:
+        return None
+    try:
+        return json_util.loads(value)
+    except (ValueError, TypeError) as e:
+        raise click.BadParameter(f"{name} isn't valid (extended) JSON: {e}")
+
+
+def _parse_projection(value: str):
+    """Takes a JSON projection or a comma-separated list of fields."""
+    if not value:
+        return None
+    if value.lstrip().startswith("{"):
+        return _parse_json(value, "--projection")
+    return {field.strip(): True for field in value.split(",") if field.strip()}
+
+
+def _read_documents(file, format: str):
+    """Yields the documents in 'file' one at a time."""
+    if format == "bson":
+        yield from bson.decode_file_iter(file)
+    else:
+        for line in file:
+            if line.strip():
+                yield json_util.loads(line, json_options=JSON_OPTIONS)
+
+
+def _write_document(file, document, format: str):
+    if format == "bson":
+        file.write(bson.encode(document))
+    else:
+        file.write(json_util.dumps(document, json_options=JSON_OPTIONS).encode())
+        file.write(b"\n")
+
+
+def _last_complete_document(path: str, format: str):
+    """Finds the last document fully written to an interrupted export.
+
+    Returns:
+        Its `_id` (None if there is none) and the size of the file up to the
+        end of that document.
+    """
+    last_id = None
+    end = 0
+    with open(path, "rb") as file:
+        if format == "bson":
+            while True:
+                header = file.read(4)
+                if len(header) < 4:
+                    break
+                size = int.from_bytes(header, "little")
+                data = header + file.read(size - 4)
+                try:
+                    document = bson.decode(data)
+                except InvalidBSON:
+                    break
+                last_id, end = document["_id"], file.tell()
+        else:
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break
+                if line.strip():
+                    try:
+                        document = json_util.loads(line, json_options=JSON_OPTIONS)
+                    except ValueError:
+                        break
+                    last_id = document["_id"]
+                end = file.tell()
+    return last_id, end
+
+
+class Progress:
+    """Reports how many documents have been processed and how fast, on
+    stderr so it doesn't get mixed with an export written to stdout."""
+
+    def __init__(self, verb: str):
+        self.verb = verb
+        self.count = 0
+        self.started = time.monotonic()
+
+    def update(self, count: int):
+        self.count += count
+        elapsed = time.monotonic() - self.started
+        click.echo(
+            f"{self.verb} {self.count} users ({self.count / elapsed:.0f}/s)", err=True
+        )
+
+
+def export_users(
+    file,
+    format: str = "ndjson",
+    filter: dict = None,
+    projection: dict = None,
+    after=None,
+    batch_size: int = 1000,
+) -> int:
+    """
+    Writes the users to 'file' in `_id` order, reading them through a batched
+    cursor so memory use doesn't depend on the size of the collection.
+
+    Args:
+        file: A binary file to write to.
+        format: 'ndjson' for one extended JSON document per line, or 'bson'.
+        filter: A query the exported users have to match.
+        projection: The fields to export. `_id` is always included.
+        after: Only export the users whose `_id` is greater than this one.
+        batch_size: How many documents to fetch from MongoDB at a time.
+
+    Returns:
+        The number of users exported.
+    """
+    query = dict(filter or {})
+    if after is not None:
+        query = {"$and": [query, {"_id": {"$gt": after}}]}
+
+    progress = Progress("Exported")
+    pending = 0
+    cursor = (
+        mongo.db.users.find(query, projection)
+        .sort("_id", ASCENDING)
+        .batch_size(batch_size)
+    )
+    with cursor:
+        for document in cursor:
+            _write_document(file, document, format)
+            pending += 1
+            if pending == batch_size:
+                file.flush()
+                progress.update(pending)
+                pending = 0
+    file.flush()
+    if pending:
+        progress.update(pending)
+    return progress.count
+
+
+def import_users(
+    file,
+    format: str = "ndjson",
+    after=None,
+    batch_size: int = 1000,
+    checkpoint: str = None,
+    max_errors: int = 10,
+):
+    """
+    Upserts the users read from 'file', a batch at a time with unordered bulk
+    writes. Replacing by `_id` makes the import idempotent, so running it
+    again after an interruption is safe. Every imported user gets a new
+    `updated_at`, so delta sync clients and the profile caches see them.
+
+    Args:
+        file: A binary file to read from, as written by `export_users`.
+        format: 'ndjson' or 'bson'.
+        after: Skip the documents whose `_id` isn't greater than this one,
+            e.g. the ones a previous, interrupted run already imported. Only
+            meaningful for files sorted by `_id`, like the exports.
+        batch_size: How many documents to write at a time.
+        checkpoint: A file to save the `_id` of the last imported document
+            in after every batch.
+        max_errors: How many of the errors reported by MongoDB to keep, the
+            rest are only counted.
+
+    Returns:
+        The number of users written, the number that failed and the first
+        'max_errors' errors.
+    """
+    users = mongo.db.users
+    progress = Progress("Imported")
+    failed = 0
+    errors = []
+
+    def write(batch):
+        nonlocal failed
+        now = dt.datetime.utcnow()
+        for document in batch:
+            document["updated_at"] = now
+        try:
+            users.bulk_write(
+                [
+                    ReplaceOne({"_id": document["_id"]}, document, upsert=True)
+                    for document in batch
+                ],
+                ordered=False,
+            )
+        except BulkWriteError as e:
+            failed += len(e.details["writeErrors"])
+            errors.extend(e.details["writeErrors"][: max_errors - len(errors)])
+        if checkpoint is not None:
+            with open(checkpoint, "w") as f:
+                f.write(json_util.dumps({"_id": batch[-1]["_id"]}))
+        progress.update(len(batch))
+
+    batch = []
+    for document in _read_documents(file, format):
+        if after is not None and document["_id"] <= after:
+            continue
+        batch.append(document)
+        if len(batch) == batch_size:
+            write(batch)
+            batch = []
+    if batch:
+        write(batch)
+    return progress.count - failed, failed, errors
+
+
+@click.command("export-users")
+@click.option("-o", "--output", default="-", help="File to write, '-' for stdout.")
+@click.option("--format", type=click.Choice(FORMATS), help="Default: from --output.")
+@click.option("--filter", "filter_", help="Query, as extended JSON.")
+@click.option("--projection", help="Comma-separated fields or a JSON projection.")
+@click.option("--batch-size", default=1000, show_default=True)
+@click.option(
+    "--resume", is_flag=True, help="Append to an interrupted export of --output."
+)
+@with_appcontext
+def export_users_command(output, format, filter_, projection, batch_size, resume):
+    format = _format_for(output, format)
+    filter_ = _parse_json(filter_, "--filter")
+    projection = _parse_projection(projection)
+
+    after = None
+    if resume and output != "-" and os.path.exists(output):
+        after, end = _last_complete_document(output, format)
+        os.truncate(output, end)
+        click.echo(f"Resuming after _id {after}", err=True)
+
+    if output == "-":
+        file = click.get_binary_stream("stdout")
+    else:
+        file = open(output, "ab" if after is not None else "wb")
+    try:
+        exported = export_users(file, format, filter_, projection, after, batch_size)
+    finally:
+        if output != "-":
+            file.close()
+    click.echo(f"Exported {exported} users.", err=True)
+
+
+@click.command("import-users")
+@click.option(
+    "-i", "--input", "input_", default="-", help="File to read, '-' for stdin."
+)
+@click.option("--format", type=click.Choice(FORMATS), help="Default: from --input.")
+@click.option("--batch-size", default=1000, show_default=True)
+@click.option(
+    "--checkpoint",
+    help="File that records the last imported _id. Default: <input>.checkpoint.",
+)
+@click.option("--resume", is_flag=True, help="Skip what --checkpoint says is done.")
+@with_appcontext
+def import_users_command(input_, format, batch_size, checkpoint, resume):
+    format = _format_for(input_, format)
+    if checkpoint is None and input_ != "-":
+        checkpoint = f"{input_}.checkpoint"
+
+    after = None
+    if resume:
+        try:
+            with open(checkpoint) as f:
+                after = json_util.loads(f.read())["_id"]
+        except (TypeError, FileNotFoundError, json.JSONDecodeError):
+            raise click.UsageError("Nothing to resume, no checkpoint was found.")
+        click.echo(f"Resuming after _id {after}", err=True)
+
+    if input_ == "-":
+        file = click.get_binary_stream("stdin")
+    else:
+        file = open(input_, "rb")
+    with file:
+        imported, failed, errors = import_users(
+            file, format, after, batch_size, checkpoint
+        )
+
+    for error in errors:
+        user_id = error["op"]["q"]["_id"]
+        click.echo(f"Failed to import {user_id}: {error['errmsg']}", err=True)
+    click.echo(f"Imported {imported} users, {failed} failed.", err=True)
+
+
+def init_app(app):
+    app.cli.add_command(export_users_command)
+    app.cli.add_command(import_users_command)
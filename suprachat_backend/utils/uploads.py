@@ -0,0 +1,52 @@
+import os
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from suprachat_backend.db import mongo
+
+
+def prune_partial_uploads(grace: float = 3600) -> int:
+    """
+    Deletes the partial files of resumable uploads whose session has expired.
+    MongoDB removes the expired sessions on its own, but not their files.
+
+    Args:
+        grace: Files modified less than this many seconds ago are kept, their
+            session might be in the middle of being created.
+
+    Returns:
+        The number of files deleted.
+    """
+    folder = current_app.config["UPLOAD_PARTIAL_FOLDER"]
+    deleted = 0
+
+    for entry in os.scandir(folder):
+        if not entry.name.endswith(".part"):
+            continue
+        if time.time() - entry.stat().st_mtime < grace:
+            continue
+        session_id = entry.name[: -len(".part")]
+        if mongo.db.upload_sessions.find_one({"_id": session_id}, {"_id": True}):
+            continue
+        try:
+            os.remove(entry.path)
+            deleted += 1
+        except FileNotFoundError:
+            pass
+
+    return deleted
+
+
+@click.command("prune-uploads")
+@click.option("--grace", default=3600, show_default=True)
+@with_appcontext
+def prune_uploads_command(grace):
+    deleted = prune_partial_uploads(grace)
+    click.echo(f"Deleted {deleted} abandoned partial uploads.")
+
+
+def init_app(app):
+    app.cli.add_command(prune_uploads_command)
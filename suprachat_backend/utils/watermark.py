@@ -0,0 +1,43 @@
+import base64
+import binascii
+import datetime as dt
+
+from bson import ObjectId
+from bson.errors import InvalidId
+
+
+def encode_watermark(updated_at: dt.datetime, user_id) -> str:
+    """
+    Builds the opaque token that marks how far a client has synced.
+
+    Args:
+        updated_at: The `updated_at` of the last change the client got.
+        user_id: The `_id` of the user that change belongs to.
+
+    Returns:
+        A URL-safe token for `decode_watermark`.
+    """
+    millis = int(updated_at.replace(tzinfo=dt.timezone.utc).timestamp() * 1000)
+    return base64.urlsafe_b64encode(f"{millis}:{user_id}".encode()).decode()
+
+
+def decode_watermark(token: str):
+    """Returns the `updated_at` and `_id` encoded in 'token', or raises
+    ValueError if it wasn't built by `encode_watermark`."""
+    try:
+        millis, user_id = base64.urlsafe_b64decode(token).decode().split(":")
+        updated_at = dt.datetime.fromtimestamp(int(millis) / 1000, dt.timezone.utc)
+        return updated_at.replace(tzinfo=None), ObjectId(user_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError, InvalidId):
+        raise ValueError(f"Invalid watermark: {token}")
+
+
+def changed_since(updated_at: dt.datetime, user_id) -> dict:
+    """A query for the users changed after the given watermark, meant to be
+    sorted by `updated_at` and `_id`."""
+    return {
+        "$or": [
+            {"updated_at": {"$gt": updated_at}},
+            {"updated_at": updated_at, "_id": {"$gt": user_id}},
+        ]
+    }
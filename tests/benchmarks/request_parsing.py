@@ -0,0 +1,73 @@
+"""Micro-benchmark of the parse/validate cost of the signup and profile update
+requests, before and after parsing the body once and caching the schemas.
+
+Run it with `python -m tests.benchmarks.request_parsing`, no database or IRCd
+needed.
+"""
+import json
+import os
+import timeit
+import warnings
+
+from flask import g
+from webargs.flaskparser import parser as webargs_parser
+
+from suprachat_backend import create_app
+from suprachat_backend.models.user import UserSchema, make_user_schema
+from suprachat_backend.utils.body import parser
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017/test")
+
+REQUESTS = {
+    "signup": (
+        "POST",
+        {"nick": "DeadOcean", "email": "admin@suprachat.net", "password": "password"},
+    ),
+    "PATCH /api/v1/users": (
+        "PATCH",
+        {"country": "México", "about": "lorem ipsum dolor sit amet"},
+    ),
+}
+
+
+def make_user_schema_uncached(request):
+    """How make_user_schema used to work, decoding the body on its own."""
+    fields = json.loads(request.data).keys()
+    partial = request.method == "PATCH"
+    return UserSchema(only=fields, partial=partial, context={"request": request})
+
+
+def run(app, method, body, parse, number):
+    def request_cycle():
+        # Forget the body parsed by the previous iteration, as a new request would
+        g.pop("json_body", None)
+        parse()
+
+    with app.test_request_context("/api/v1/users", method=method, json=body):
+        return min(timeit.repeat(request_cycle, number=number, repeat=5)) / number
+
+
+def main(number=2000):
+    app = create_app({"TESTING": True})
+    warnings.simplefilter("ignore", DeprecationWarning)
+
+    for name, (method, body) in REQUESTS.items():
+        before = run(
+            app,
+            method,
+            body,
+            lambda: webargs_parser.parse(make_user_schema_uncached, location="json"),
+            number,
+        )
+        after = run(
+            app,
+            method,
+            body,
+            lambda: parser.parse(make_user_schema, location="json"),
+            number,
+        )
+        print(f"{name}: before {before * 1e6:.1f} µs, after {after * 1e6:.1f} µs")
+
+
+if __name__ == "__main__":
+    main()